@@ -3,27 +3,140 @@
 import sys
 import os
 sys.path.append('hooks/')
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+)
+from ophistory import (
+    latency_summary,
+    op_history,
+    slow_monitors,
+)
+from profiler import summary
 from utils import (
+    estimate_crypto_cost,
+    benchmark_failover,
+    get_crypto_settings,
     pause_unit,
     resume_unit,
 )
 
 
+def report_progress(pending, elapsed):
+    """Stream the resources still moving and the time spent so far."""
+    action_set({'progress.remaining': len(pending),
+                'progress.resources': ', '.join(pending) or 'none',
+                'progress.elapsed': '%.0fs' % elapsed})
+
+
 def pause(args):
     """Pause the hacluster services.
     @raises Exception should the service fail to stop.
     """
-    pause_unit()
+    pause_unit(action_get('timeout'), action_get('interval'),
+               report_progress)
 
 
 def resume(args):
     """Resume the hacluster services.
     @raises Exception should the service fail to start."""
-    resume_unit()
+    resume_unit(action_get('timeout'), action_get('interval'),
+                report_progress)
+
+
+def show_profile(args):
+    """Show the slowest commands run by each profiled hook."""
+    results = {}
+    for hook_name, profile in summary(action_get('count')).items():
+        results['%s.total' % hook_name] = '%.2fs' % profile['total']
+        results['%s.commands' % hook_name] = profile['commands']
+        results['%s.slowest' % hook_name] = '\n'.join(
+            '%.2fs rc=%s %s' % (r['duration'], r['rc'], r['cmd'])
+            for r in profile['slowest'])
+
+    if not results:
+        results['message'] = 'No hook profiles recorded, set profile_hooks'
+
+    action_set(results)
+
+
+def crypto_estimate(args):
+    """Estimate the cost of each corosync crypto setting with OpenSSL."""
+    message_size = action_get('message-size')
+    results = estimate_crypto_cost(message_size)
+    output = {'note': 'openssl speed estimate, corosync itself uses NSS'}
+    for kind, settings in results.items():
+        for setting, (rate, cost) in settings.items():
+            key = '%s.%s' % (kind, setting)
+            output['%s.openssl-throughput' % key] = '%.1f MB/s' % (rate / 1e6)
+            output['%s.estimated-message-cost' % key] = '%.2f us' % cost
+
+    crypto = get_crypto_settings()
+    cost = sum(results[kind][crypto[kind]][1]
+               for kind in ['cipher', 'hash']
+               if crypto[kind] in results[kind])
+    output['configured'] = '%s/%s' % (crypto['cipher'], crypto['hash'])
+    output['configured-estimated-message-cost'] = '%.2f us' % cost
+    action_set(output)
+
+
+def _action_key(name):
+    """Turn a pacemaker id into a valid action output key"""
+    return name.lower().replace('_', '-').replace(':', '-')
+
+
+def op_latency(args):
+    """Report resource operation latencies from the pacemaker op history."""
+    ops = op_history()
+    results = {}
+    for (name, operation), stats in latency_summary(
+            ops, key=action_get('group-by')).items():
+        results['%s.%s' % (_action_key(name), operation)] = (
+            'n=%d p50=%.3fs p90=%.3fs p99=%.3fs max=%.3fs queue-max=%.3fs' %
+            (stats['count'], stats['p50'], stats['p90'], stats['p99'],
+             stats['max'], stats['queue_max']))
+
+    slow = slow_monitors(ops, action_get('threshold'))
+    if slow:
+        results['slow-monitors'] = '\n'.join(
+            '%s (%s) on %s: %.3fs of a %ds interval' %
+            (op['resource'], op['agent'], op['node'],
+             op['exec_time'] + op['queue_time'], op['interval'])
+            for op in slow)
+
+    if not results:
+        results['message'] = 'No resource operations recorded'
+
+    action_set(results)
+
+
+def failover_benchmark(args):
+    """Measure how long resources take to leave and return to this unit."""
+    results = benchmark_failover(action_get('timeout'),
+                                 action_get('failback-timeout'),
+                                 action_get('interval'))
+    output = {}
+    for phase in ['failover', 'failback']:
+        times = results[phase]
+        for resource, seconds in times.items():
+            output['%s.%s' % (phase, _action_key(resource))] = (
+                'timed out' if seconds is None else '%.2fs' % seconds)
+
+        moved = [seconds for seconds in times.values() if seconds is not None]
+        output['%s.total' % phase] = '%.2fs' % max(moved) if moved else 'n/a'
+        output['%s.timed-out' % phase] = len(times) - len(moved)
+
+    for resource in results['sticky']:
+        output['failback.%s' % _action_key(resource)] = (
+            'stays on its new node (resource-stickiness)')
+
+    action_set(output)
 
 
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume, "show-profile": show_profile,
+           "crypto-estimate": crypto_estimate, "op-latency": op_latency,
+           "benchmark-failover": failover_benchmark}
 
 
 def main(args):
@@ -8,7 +8,9 @@ import sys
 import glob
 
 import pcmk
+import profiler
 import socket
+import subprocess
 
 from charmhelpers.core.hookenv import (
     log,
@@ -25,10 +27,13 @@ from charmhelpers.core.hookenv import (
     status_set,
 )
 
+from charmhelpers.core.unitdata import kv
+
 from charmhelpers.core.host import (
     service_stop,
     service_running,
     mkdir,
+    write_file,
 )
 
 from charmhelpers.fetch import (
@@ -51,11 +56,18 @@ from utils import (
     configure_stonith,
     configure_monitor_host,
     configure_cluster_global,
+    configure_metrics_exporter,
+    remove_metrics_exporter,
     enable_lsb_services,
     disable_lsb_services,
     disable_upstart_services,
     get_ipv6_addr,
     set_unit_status,
+    get_relation_snapshot,
+    relation_snapshot_changed,
+    save_relation_snapshot,
+    process_pending_corosync_restart,
+    get_ring1_address,
 )
 
 from charmhelpers.contrib.charmsupport import nrpe
@@ -76,10 +88,13 @@ COROSYNC_CONF_FILES = [
     COROSYNC_CONF
 ]
 
-PACKAGES = ['corosync', 'pacemaker', 'python-netaddr', 'ipmitool',
-            'libnagios-plugin-perl']
 SUPPORTED_TRANSPORTS = ['udp', 'udpu', 'multicast', 'unicast']
 DEPRECATED_TRANSPORT_VALUES = {"multicast": "udp", "unicast": "udpu"}
+# kv key holding the crm statements last applied for the principal
+APPLIED_OBJECTS_KEY = 'hacluster-applied-objects'
+NAGIOS_PLUGINS_DIR = '/usr/local/lib/nagios/plugins'
+STATUS_COLLECTOR_CRON = '/etc/cron.d/hacluster-status-collector'
+STATUS_CACHE = '/var/lib/nagios/hacluster-status.json'
 
 
 @hooks.hook()
@@ -119,6 +134,44 @@ def ensure_ipv6_requirements(hanode_rid):
                      **{'private-address': addr})
 
 
+def get_desired_objects(resources, resource_params, groups, ms, orders,
+                        colocations, clones, locations):
+    """Build the crm configure statements requested by the principal
+
+    @returns dict of object id -> crm configure statement
+    """
+    desired = {}
+    for res_name, res_type in resources.iteritems():
+        if res_name not in resource_params:
+            desired[res_name] = 'primitive %s %s' % (res_name, res_type)
+        else:
+            desired[res_name] = ('primitive %s %s %s' %
+                                 (res_name, res_type,
+                                  resource_params[res_name]))
+
+        if config('monitor_host'):
+            loc_name = 'Ping-%s' % res_name
+            desired[loc_name] = ('location %s %s rule -inf: pingd lte 0' %
+                                 (loc_name, res_name))
+
+    for kind, objects in [('group', groups),
+                          ('ms', ms),
+                          ('order', orders),
+                          ('colocation', colocations),
+                          ('clone', clones),
+                          ('location', locations)]:
+        for obj_name, obj_params in objects.iteritems():
+            desired[obj_name] = '%s %s %s' % (kind, obj_name, obj_params)
+
+    return desired
+
+
+def publish_ring1_address(hanode_rid):
+    """Share this unit's address on the redundant corosync ring"""
+    relation_set(relation_id=hanode_rid,
+                 **{'ring1-address': get_ring1_address()})
+
+
 @hooks.hook()
 def config_changed():
     if config('prefer-ipv6'):
@@ -132,9 +185,10 @@ def config_changed():
 
     enable_lsb_services('pacemaker')
 
-    if config('prefer-ipv6'):
-        for rid in relation_ids('hanode'):
+    for rid in relation_ids('hanode'):
+        if config('prefer-ipv6'):
             ensure_ipv6_requirements(rid)
+        publish_ring1_address(rid)
 
     status_set('maintenance', "Setting up corosync")
     if configure_corosync():
@@ -143,13 +197,27 @@ def config_changed():
         configure_monitor_host()
         configure_stonith()
 
+    # retry a restart deferred earlier, e.g. while a peer was offline
+    process_pending_corosync_restart()
+
+    configure_metrics_exporter()
     update_nrpe_config()
 
 
+@hooks.hook('leader-elected',
+            'leader-settings-changed',
+            'update-status')
+def process_corosync_restart():
+    # the leader hands out the restart lock, a granted unit restarts and
+    # a deferred restart is retried periodically
+    process_pending_corosync_restart()
+
+
 @hooks.hook()
 def upgrade_charm():
     install()
 
+    configure_metrics_exporter()
     update_nrpe_config()
 
 
@@ -158,6 +226,10 @@ def upgrade_charm():
 def hanode_relation_changed():
     if config('prefer-ipv6'):
         ensure_ipv6_requirements(None)
+    publish_ring1_address(None)
+
+    # A peer finishing its corosync restart may make it our turn
+    process_pending_corosync_restart()
 
     ha_relation_changed()
 
@@ -165,6 +237,14 @@ def hanode_relation_changed():
 @hooks.hook('ha-relation-joined',
             'ha-relation-changed')
 def ha_relation_changed():
+    # Nothing to do if neither the relation data nor the config changed
+    # since the cluster was last configured successfully.
+    settings, digest = get_relation_snapshot()
+    if not relation_snapshot_changed(digest):
+        log('ha and hanode relation data unchanged, skipping '
+            'reconfiguration', level=DEBUG)
+        return
+
     # Check that we are related to a principle and that
     # it has already provided the required corosync configuration
     if not get_corosync_conf():
@@ -232,14 +312,14 @@ def ha_relation_changed():
     # Only configure the cluster resources
     # from the oldest peer unit.
     if oldest_peer(peer_units()):
-        log('Deleting Resources' % (delete_resources), level=DEBUG)
-        for res_name in delete_resources:
-            if pcmk.crm_opt_exists(res_name):
-                log('Stopping and deleting resource %s' % res_name,
-                    level=DEBUG)
-                if pcmk.crm_res_running(res_name):
-                    pcmk.commit('crm -w -F resource stop %s' % res_name)
-                pcmk.commit('crm -w -F configure delete %s' % res_name)
+        log('Deleting Resources: %s' % (delete_resources), level=DEBUG)
+        pcmk.delete_objects(delete_resources)
+
+        db = kv()
+        applied = db.get(APPLIED_OBJECTS_KEY, {})
+        desired = get_desired_objects(resources, resource_params, groups, ms,
+                                      orders, colocations, clones, locations)
+        create, update, delete = pcmk.reconcile(desired, applied)
 
         log('Configuring Resources: %s' % (resources), level=DEBUG)
         for res_name, res_type in resources.iteritems():
@@ -254,69 +334,22 @@ def ha_relation_changed():
                 disable_upstart_services(init_services[res_name])
                 if service_running(init_services[res_name]):
                     service_stop(init_services[res_name])
-            # Put the services in HA, if not already done so
-            # if not pcmk.is_resource_present(res_name):
-            if not pcmk.crm_opt_exists(res_name):
-                if res_name not in resource_params:
-                    cmd = 'crm -w -F configure primitive %s %s' % (res_name,
-                                                                   res_type)
-                else:
-                    cmd = ('crm -w -F configure primitive %s %s %s' %
-                           (res_name, res_type, resource_params[res_name]))
 
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
-                if config('monitor_host'):
-                    cmd = ('crm -F configure location Ping-%s %s rule '
-                           '-inf: pingd lte 0' % (res_name, res_name))
-                    pcmk.commit(cmd)
+        # New and changed objects are applied in place as a single CIB
+        # update; unchanged objects are left alone.
+        batch = pcmk.ConfigBatch()
+        for obj_id in create + update:
+            log('%s' % desired[obj_id], level=DEBUG)
+            batch.add(desired[obj_id])
 
-        log('Configuring Groups: %s' % (groups), level=DEBUG)
-        for grp_name, grp_params in groups.iteritems():
-            if not pcmk.crm_opt_exists(grp_name):
-                cmd = ('crm -w -F configure group %s %s' %
-                       (grp_name, grp_params))
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
+        batch.commit()
 
-        log('Configuring Master/Slave (ms): %s' % (ms), level=DEBUG)
-        for ms_name, ms_params in ms.iteritems():
-            if not pcmk.crm_opt_exists(ms_name):
-                cmd = 'crm -w -F configure ms %s %s' % (ms_name, ms_params)
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
+        # Objects previously applied which the principal no longer requests
+        log('Removing stale objects: %s' % (delete), level=DEBUG)
+        pcmk.delete_objects(delete)
 
-        log('Configuring Orders: %s' % (orders), level=DEBUG)
-        for ord_name, ord_params in orders.iteritems():
-            if not pcmk.crm_opt_exists(ord_name):
-                cmd = 'crm -w -F configure order %s %s' % (ord_name,
-                                                           ord_params)
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
-
-        log('Configuring Colocations: %s' % colocations, level=DEBUG)
-        for col_name, col_params in colocations.iteritems():
-            if not pcmk.crm_opt_exists(col_name):
-                cmd = 'crm -w -F configure colocation %s %s' % (col_name,
-                                                                col_params)
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
-
-        log('Configuring Clones: %s' % clones, level=DEBUG)
-        for cln_name, cln_params in clones.iteritems():
-            if not pcmk.crm_opt_exists(cln_name):
-                cmd = 'crm -w -F configure clone %s %s' % (cln_name,
-                                                           cln_params)
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
-
-        log('Configuring Locations: %s' % locations, level=DEBUG)
-        for loc_name, loc_params in locations.iteritems():
-            if not pcmk.crm_opt_exists(loc_name):
-                cmd = 'crm -w -F configure location %s %s' % (loc_name,
-                                                              loc_params)
-                pcmk.commit(cmd)
-                log('%s' % cmd, level=DEBUG)
+        db.set(APPLIED_OBJECTS_KEY, desired)
+        db.flush()
 
         for res_name, res_type in resources.iteritems():
             if len(init_services) != 0 and res_name in init_services:
@@ -333,33 +366,57 @@ def ha_relation_changed():
                     cmd = 'crm resource cleanup %s' % res_name
                     pcmk.commit(cmd)
 
-        for cl_name in clones:
-            # Always cleanup clones
-            cmd = 'crm resource cleanup %s' % cl_name
-            pcmk.commit(cmd)
-
-        for grp_name in groups:
-            # Always cleanup groups
-            cmd = 'crm resource cleanup %s' % grp_name
-            pcmk.commit(cmd)
+        for obj_name in create + update:
+            if obj_name in clones or obj_name in groups:
+                # Always cleanup new or changed clones and groups
+                cmd = 'crm resource cleanup %s' % obj_name
+                pcmk.commit(cmd)
 
     for rel_id in relation_ids('ha'):
         relation_set(relation_id=rel_id, clustered="yes")
 
+    save_relation_snapshot(settings, digest)
+
 
 @hooks.hook()
 def stop():
     cmd = 'crm -w -F node delete %s' % socket.gethostname()
     pcmk.commit(cmd)
+    remove_metrics_exporter()
+    remove_status_collector()
     apt_purge(['corosync', 'pacemaker'], fatal=True)
 
 
+def configure_status_collector():
+    """Sample the cluster state for the NRPE checks every minute
+
+    The checks only read the cluster state sampled by the collector, so
+    polling them does not run crm_mon or corosync-cfgtool each time. Units
+    nobody monitors do not run the collector at all.
+    """
+    if not relation_ids('nrpe-external-master'):
+        remove_status_collector()
+        return
+
+    collector = os.path.join(NAGIOS_PLUGINS_DIR, 'collect_cluster_status')
+    write_file(STATUS_COLLECTOR_CRON,
+               '* * * * * root {}\n'.format(collector), perms=0o644)
+    subprocess.call([collector])
+
+
+@hooks.hook('nrpe-external-master-relation-broken')
+def remove_status_collector():
+    for path in [STATUS_COLLECTOR_CRON, STATUS_CACHE]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
 @hooks.hook('nrpe-external-master-relation-joined',
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
     scripts_src = os.path.join(os.environ["CHARM_DIR"], "files",
                                "nrpe")
-    scripts_dst = "/usr/local/lib/nagios/plugins"
+    scripts_dst = NAGIOS_PLUGINS_DIR
     if not os.path.exists(scripts_dst):
         os.makedirs(scripts_dst)
     for fname in glob.glob(os.path.join(scripts_src, "*")):
@@ -375,6 +432,8 @@ def update_nrpe_config():
             shutil.copy2(fname,
                          os.path.join(sudoers_dst, os.path.basename(fname)))
 
+    configure_status_collector()
+
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
 
@@ -404,12 +463,30 @@ def update_nrpe_config():
         check_cmd='check_procs -c 1:1 -C pacemakerd'
     )
 
+    # metrics exporter
+    if config('metrics_port'):
+        address = config('metrics_address')
+        if not address or address in ['0.0.0.0', '::']:
+            address = '127.0.0.1'
+        nrpe_setup.add_check(
+            shortname='hacluster_exporter',
+            description='Check metrics exporter {%s}' % current_unit,
+            check_cmd='check_http -I %s -p %d -u /metrics' %
+            (address, config('metrics_port'))
+        )
+    else:
+        nrpe_setup.remove_check(shortname='hacluster_exporter')
+
     nrpe_setup.write()
 
 
 if __name__ == '__main__':
+    if config('profile_hooks'):
+        profiler.enable()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e), level=DEBUG)
+    finally:
+        profiler.save(os.path.basename(sys.argv[0]))
     set_unit_status()
@@ -1,16 +1,124 @@
-import apt_pkg as apt
-
 import json
-import subprocess
+import os
+import time
+import uuid
+
+from six.moves import http_client
+from six.moves.urllib.parse import (
+    quote,
+    urlencode,
+    urlparse,
+)
 
-from charmhelpers.fetch import apt_install
 from charmhelpers.core.hookenv import (
     log,
+    DEBUG,
     ERROR,
 )
+from charmhelpers.core.host import write_file
+
+# Power parameters are credentials, keep the cache readable by root only
+MAAS_CACHE_FILE = os.path.join(os.environ.get('CHARM_DIR', ''),
+                               '.maas-nodes.json')
+MAAS_NODE_FIELDS = ['hostname', 'power_type', 'power_parameters']
+
+
+class MAASError(Exception):
+    pass
+
+
+class MAASClient(object):
+    """Minimal client for the MAAS 1.0 REST API
+
+    Requests are signed with the API key (consumer key, token key and token
+    secret separated by ':') using OAuth 1.0 PLAINTEXT signatures and are
+    sent over one persistent HTTP connection.
+    """
+
+    def __init__(self, url, creds, timeout=30):
+        parsed = urlparse(url)
+        path = parsed.path.rstrip('/')
+        if '/api/' not in path + '/':
+            path += '/api/1.0'
+
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.path = path
+        self.timeout = timeout
+        try:
+            self.consumer_key, self.token_key, self.token_secret = \
+                creds.split(':')
+        except ValueError:
+            raise MAASError('MAAS credentials must be of the form '
+                            '<consumer key>:<token key>:<token secret>')
+
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            if self.scheme == 'https':
+                self._conn = http_client.HTTPSConnection(
+                    self.netloc, timeout=self.timeout)
+            else:
+                self._conn = http_client.HTTPConnection(
+                    self.netloc, timeout=self.timeout)
+
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _auth_header(self):
+        params = [
+            ('realm', ''),
+            ('oauth_version', '1.0'),
+            ('oauth_signature_method', 'PLAINTEXT'),
+            ('oauth_consumer_key', self.consumer_key),
+            ('oauth_token', self.token_key),
+            ('oauth_signature', '&%s' % quote(self.token_secret, safe='')),
+            ('oauth_nonce', uuid.uuid4().hex),
+            ('oauth_timestamp', str(int(time.time()))),
+        ]
+        return 'OAuth ' + ', '.join('%s="%s"' % (k, quote(v, safe=''))
+                                    for k, v in params)
 
-MAAS_STABLE_PPA = 'ppa:maas-maintainers/stable '
-MAAS_PROFILE_NAME = 'maas-juju-hacluster'
+    def get(self, resource, params):
+        """GET a resource below the API root
+
+        @param resource: resource path, e.g. 'nodes/'
+        @param params: list of (name, value) query parameters
+        @returns decoded JSON response
+        @raises MAASError if the request fails
+        """
+        url = '%s/%s?%s' % (self.path, resource, urlencode(params))
+        headers = {'Authorization': self._auth_header(),
+                   'Accept': 'application/json'}
+        # A kept-alive connection may have been closed by the server in the
+        # meantime, retry once on a fresh connection.
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request('GET', url, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http_client.HTTPException, IOError) as e:
+                self.close()
+                if attempt:
+                    raise MAASError('Request to MAAS failed: %s' % e)
+
+        if response.status != 200:
+            raise MAASError('MAAS returned %s for %s: %s' %
+                            (response.status, url, body))
+
+        try:
+            return json.loads(body)
+        except ValueError:
+            # e.g. the login page of a proxy in front of MAAS
+            raise MAASError('MAAS returned a response for %s which is not '
+                            'JSON: %s' % (url, body[:200]))
 
 
 class MAASHelper(object):
@@ -18,50 +126,83 @@ class MAASHelper(object):
     def __init__(self, url, creds):
         self.url = url
         self.creds = creds
-        self.install_maas_cli()
 
-    def install_maas_cli(self):
-        """Ensure maas-cli is installed
+    def list_nodes(self, hostnames=None):
+        """List the hostname and power settings of the nodes known to MAAS
 
-        Fallback to MAAS stable PPA when needed.
+        @param hostnames: only return nodes whose short hostname is listed
+        @returns list of node dicts or False if MAAS could not be queried
         """
-        apt.init()
-        cache = apt.Cache()
-
-        try:
-            pkg = cache['maas-cli']
-        except KeyError:
-            cmd = ['add-apt-repository', '-y', MAAS_STABLE_PPA]
-            subprocess.check_call(cmd)
-            cmd = ['apt-get', 'update']
-            subprocess.check_call(cmd)
-            self.install_maas_cli()
-            return
-
-        if not pkg.current_ver:
-            apt_install('maas-cli', fatal=True)
-
-    def login(self):
-        cmd = ['maas-cli', 'login', MAAS_PROFILE_NAME, self.url, self.creds]
+        client = MAASClient(self.url, self.creds)
         try:
-            subprocess.check_call(cmd)
-        except subprocess.CalledProcessError:
-            log('Could not login to MAAS @ %s.' % self.url, ERROR)
-            return False
+            params = [('op', 'list')]
+            nodes = None
+            if hostnames is not None:
+                params += [('hostname', host) for host in hostnames]
+                nodes = client.get('nodes/', params)
+                found = set(node['hostname'].split('.')[0] for node in nodes)
+                if not set(hostnames).issubset(found):
+                    # MAAS releases which store the FQDN as hostname do not
+                    # match short names, fall back to filtering locally.
+                    nodes = None
 
-    def logout(self):
-        cmd = ['maas-cli', 'logout', MAAS_PROFILE_NAME]
-        subprocess.check_call(cmd)
+            if nodes is None:
+                nodes = client.get('nodes/', [('op', 'list')])
 
-    def list_nodes(self):
-        self.login()
+            if hostnames is not None:
+                nodes = [node for node in nodes
+                         if node['hostname'].split('.')[0] in hostnames]
 
-        try:
-            cmd = ['maas-cli', MAAS_PROFILE_NAME, 'nodes', 'list']
-            out = subprocess.check_output(cmd)
-        except subprocess.CalledProcessError:
-            log('Could not get node inventory from MAAS.', ERROR)
+            missing = [node['system_id'] for node in nodes
+                       if node.get('power_parameters') is None]
+            if missing:
+                power = client.get('nodes/', [('op', 'power_parameters')] +
+                                   [('id', sid) for sid in missing])
+                for node in nodes:
+                    if node['system_id'] in power:
+                        node['power_parameters'] = power[node['system_id']]
+        except MAASError as e:
+            log('Could not get node inventory from MAAS: %s' % e, ERROR)
             return False
+        finally:
+            client.close()
 
-        self.logout()
-        return json.loads(out)
+        return [dict((field, node.get(field)) for field in MAAS_NODE_FIELDS)
+                for node in nodes]
+
+    def cached_nodes(self, hostnames, ttl=3600):
+        """Return the power settings of the given nodes
+
+        Only the fields needed for STONITH of the requested nodes are kept,
+        in a cache file which is reused for up to ttl seconds. MAAS is
+        queried again once the cache expires, if it belongs to another
+        MAAS endpoint or if it is missing one of the requested nodes.
+
+        @param hostnames: short hostnames of the cluster nodes
+        @param ttl: seconds the cache stays valid for, 0 disables it
+        @returns list of node dicts or False if MAAS could not be queried
+        """
+        cache = self._read_cache()
+        if (ttl and cache.get('url') == self.url and
+                time.time() - cache.get('updated', 0) < ttl and
+                all(host in cache['nodes'] for host in hostnames)):
+            log('Using cached MAAS inventory', DEBUG)
+            return [cache['nodes'][host] for host in hostnames]
+
+        nodes = self.list_nodes(hostnames)
+        if not nodes:
+            return nodes
+
+        cache = {'url': self.url,
+                 'updated': time.time(),
+                 'nodes': dict((node['hostname'].split('.')[0], node)
+                               for node in nodes)}
+        write_file(MAAS_CACHE_FILE, json.dumps(cache), perms=0o600)
+        return nodes
+
+    def _read_cache(self):
+        try:
+            with open(MAAS_CACHE_FILE) as cache:
+                return json.load(cache)
+        except (IOError, ValueError):
+            return {}
@@ -0,0 +1,129 @@
+#
+# Copyright 2016 Canonical Ltd.
+#
+"""Integer based IPv4/IPv6 address and prefix helpers"""
+import socket
+
+from binascii import hexlify, unhexlify
+
+FAMILIES = {4: socket.AF_INET, 6: socket.AF_INET6}
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def ip_version(address):
+    """Return 4 or 6 depending on the address family of address"""
+    return 6 if ':' in address else 4
+
+
+def ip_to_int(address):
+    """Convert an address to an integer
+
+    @param address: IPv4 or IPv6 address, without a scope or prefix
+    @returns tuple of the IP version and the address as an integer
+    @raises ValueError if address is not a valid address
+    """
+    version = ip_version(address)
+    try:
+        packed = socket.inet_pton(FAMILIES[version], address)
+    except (socket.error, TypeError):
+        raise ValueError("Invalid IP address '%s'" % address)
+
+    return version, int(hexlify(packed), 16)
+
+
+def int_to_ip(value, version):
+    """Convert an integer back to its canonical address string"""
+    packed = unhexlify('%0*x' % (ADDRESS_BITS[version] // 4, value))
+    return socket.inet_ntop(FAMILIES[version], packed)
+
+
+def normalize(address):
+    """Return the canonical form of an address, e.g. 2001:db8::1"""
+    return int_to_ip(*reversed(ip_to_int(address)))
+
+
+def prefix_mask(prefixlen, version):
+    """Return the integer netmask of a prefix length"""
+    bits = ADDRESS_BITS[version]
+    return ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+
+
+def netmask_to_prefixlen(netmask):
+    """Convert a dotted or colon separated netmask to a prefix length
+
+    @raises ValueError if the netmask bits are not contiguous
+    """
+    version, mask = ip_to_int(netmask)
+    prefixlen = bin(mask).count('1')
+    if mask != prefix_mask(prefixlen, version):
+        raise ValueError("Invalid netmask '%s'" % netmask)
+
+    return prefixlen
+
+
+def _prefixlen(prefix, version):
+    if isinstance(prefix, int):
+        if not 0 <= prefix <= ADDRESS_BITS[version]:
+            raise ValueError("Invalid prefix length '%s'" % prefix)
+        return prefix
+
+    prefix = str(prefix)
+    if prefix.isdigit():
+        return _prefixlen(int(prefix), version)
+
+    return netmask_to_prefixlen(prefix)
+
+
+def network_address(address, prefix):
+    """Return the network address of address in a prefix
+
+    @param address: IPv4 or IPv6 address
+    @param prefix: prefix length or netmask
+    @returns network address string, e.g. 10.5.0.0
+    """
+    version, value = ip_to_int(address)
+    mask = prefix_mask(_prefixlen(prefix, version), version)
+    return int_to_ip(value & mask, version)
+
+
+def in_network(address, network, prefix):
+    """Return True if address belongs to network/prefix"""
+    version, value = ip_to_int(address)
+    net_version, net = ip_to_int(network)
+    if version != net_version:
+        return False
+
+    mask = prefix_mask(_prefixlen(prefix, version), version)
+    return value & mask == net & mask
+
+
+def addresses_in_networks(addresses, networks):
+    """Return the addresses which belong to any of the given networks
+
+    The networks are indexed by IP version and prefix length, so each
+    address is checked with one mask and set lookup per distinct prefix
+    length instead of once per network. Invalid addresses are skipped.
+
+    @param addresses: iterable of address strings
+    @param networks: iterable of (address, prefix length or netmask)
+    @returns set of the matching addresses in canonical form
+    """
+    index = {}
+    for network, prefix in networks:
+        version, value = ip_to_int(network)
+        mask = prefix_mask(_prefixlen(prefix, version), version)
+        index.setdefault((version, mask), set()).add(value & mask)
+
+    found = set()
+    for address in addresses:
+        try:
+            version, value = ip_to_int(address)
+        except ValueError:
+            continue
+
+        for (net_version, mask), nets in index.items():
+            if net_version == version and value & mask in nets:
+                found.add(int_to_ip(value, version))
+                break
+
+    return found
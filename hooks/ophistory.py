@@ -0,0 +1,118 @@
+#
+# Copyright 2016 Canonical Ltd.
+#
+import math
+
+import pcmk
+
+OPERATIONS = ['start', 'stop', 'monitor']
+PERCENTILES = [50, 90, 99]
+
+
+def _seconds(value):
+    return int(value or 0) / 1000.0
+
+
+def op_history(cib=None):
+    """Return the resource operations recorded in the CIB status section
+
+    pacemaker keeps the last run of each operation per resource and node,
+    together with how long it ran (exec-time) and waited for the lrmd
+    (queue-time). The extra record it keeps of the last failure repeats
+    one of those runs and is skipped. One-shot monitors (interval 0) are
+    the probes pacemaker runs to find where a resource is active, so they
+    are reported as 'probe' rather than mixed with the recurring monitors.
+
+    @param cib: pcmk.CIB to read, the live CIB by default
+    @returns list of dicts with the resource, agent, node, operation,
+             interval, exec_time and queue_time (in seconds) and rc
+    """
+    if cib is None:
+        cib = pcmk.get_cib()
+
+    ops = []
+    for node_state in cib.root.findall('status/node_state'):
+        node = node_state.get('uname')
+        for lrm_resource in node_state.iter('lrm_resource'):
+            agent = ':'.join(part for part in [lrm_resource.get('class'),
+                                               lrm_resource.get('provider'),
+                                               lrm_resource.get('type')]
+                             if part)
+            # anonymous clone instances are recorded as <id>:<n>
+            resource = lrm_resource.get('id').split(':')[0]
+            for op in lrm_resource.findall('lrm_rsc_op'):
+                operation = op.get('operation')
+                if (operation not in OPERATIONS or
+                        '_last_failure_' in op.get('id', '')):
+                    continue
+
+                interval = _seconds(op.get('interval'))
+                if operation == 'monitor' and not interval:
+                    operation = 'probe'
+
+                ops.append({
+                    'resource': resource,
+                    'agent': agent,
+                    'node': node,
+                    'operation': operation,
+                    'interval': interval,
+                    'exec_time': _seconds(op.get('exec-time')),
+                    'queue_time': _seconds(op.get('queue-time')),
+                    'rc': int(op.get('rc-code', 0)),
+                })
+
+    return ops
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values using the nearest-rank method"""
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def latency_summary(ops, key='resource'):
+    """Summarise the exec and queue times per resource and operation
+
+    @param ops: operations as returned by op_history
+    @param key: 'resource' or 'agent', what to group the operations by
+    @returns dict of (key, operation) -> dict with the number of operations,
+             the exec time percentiles (p50, p90, p99), the maximum exec time
+             and the maximum queue time
+    """
+    groups = {}
+    for op in ops:
+        groups.setdefault((op[key], op['operation']), []).append(op)
+
+    summary = {}
+    for group, group_ops in groups.items():
+        exec_times = [op['exec_time'] for op in group_ops]
+        stats = {'count': len(group_ops),
+                 'max': max(exec_times),
+                 'queue_max': max(op['queue_time'] for op in group_ops)}
+        for pct in PERCENTILES:
+            stats['p%d' % pct] = percentile(exec_times, pct)
+        summary[group] = stats
+
+    return summary
+
+
+def slow_monitors(ops, threshold=0.5):
+    """Find recurring monitors whose run time comes close to their interval
+
+    A monitor taking most of its interval keeps the lrmd busy and risks
+    overlapping with the next run or hitting its timeout.
+
+    @param threshold: fraction of the interval from which to flag a monitor
+    @returns list of monitor operations, slowest relative to their interval
+             first
+    """
+    slow = [op for op in ops
+            if op['operation'] == 'monitor' and op['interval'] and
+            op['exec_time'] + op['queue_time'] >= threshold * op['interval']]
+    return sorted(slow, reverse=True,
+                  key=lambda op: (op['exec_time'] + op['queue_time']) /
+                  op['interval'])
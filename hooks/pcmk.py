@@ -1,33 +1,444 @@
-import commands
 import subprocess
 import socket
+import tempfile
+import time
+import xml.etree.ElementTree as ET
 
 from charmhelpers.core.hookenv import (
     log,
-    ERROR
+    DEBUG,
+    ERROR,
+    WARNING,
 )
 
+# Snapshots shared by every lookup made during a hook, see get_cib() and
+# get_cluster_status()
+_cib = None
+_cluster_status = None
 
-def wait_for_pcmk():
-    crm_up = None
+
+def crm_node_members():
+    """List the nodes pacemaker currently counts as cluster members
+
+    Uses crm_node rather than the crm shell as it is much cheaper to run.
+
+    @returns list of node names, empty if pacemaker is not up yet
+    """
+    try:
+        out = subprocess.check_output(['crm_node', '-l'],
+                                      stderr=subprocess.STDOUT)
+    except (subprocess.CalledProcessError, OSError):
+        return []
+
+    # Each line is '<id> <name> <state>', nodes which left the cluster stay
+    # listed as 'lost'
+    return [fields[1] for fields in
+            (line.split() for line in out.splitlines())
+            if len(fields) > 2 and fields[2] == 'member']
+
+
+def wait_for_pcmk(timeout=300, delay=1, max_delay=10):
+    """Wait for pacemaker to list this node as a cluster member
+
+    The node list is polled with an exponential backoff between probes.
+
+    @param timeout: seconds to wait before giving up
+    @param delay: seconds to wait after the first failed probe
+    @param max_delay: upper bound for the wait between probes
+    @returns float - seconds it took pacemaker to converge
+    @raises Exception if the node is not listed within timeout seconds
+    """
     hostname = socket.gethostname()
-    while not crm_up:
-        output = commands.getstatusoutput("crm node list")[1]
-        crm_up = hostname in output
+    start = time.time()
+    while True:
+        if hostname in crm_node_members():
+            elapsed = time.time() - start
+            log('Pacemaker ready after %.1fs' % elapsed, DEBUG)
+            return elapsed
+
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            raise Exception('Pacemaker failed to list %s as a cluster '
+                            'member within %ss' % (hostname, timeout))
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def commit(cmd, failure_is_fatal=False):
+    """Run a crm command which changes the cluster
+
+    @param failure_is_fatal: raise CalledProcessError if the command fails
+                             instead of carrying on
+    """
+    try:
+        if failure_is_fatal:
+            subprocess.check_call(cmd.split())
+        else:
+            subprocess.call(cmd.split())
+    finally:
+        invalidate_cib()
+        invalidate_cluster_status()
+
+
+class CIB(object):
+    """Parsed snapshot of the cluster information base
+
+    Configuration objects are indexed by id so that lookups do not need to
+    query the cluster again.
+    """
+
+    RESOURCE_TAGS = {
+        'primitive': 'primitives',
+        'group': 'groups',
+        'clone': 'clones',
+        'master': 'ms',
+    }
+    CONSTRAINT_TAGS = ['rsc_location', 'rsc_order', 'rsc_colocation',
+                       'rsc_ticket']
+
+    def __init__(self, xml):
+        self.root = ET.fromstring(xml)
+        self.primitives = {}
+        self.groups = {}
+        self.clones = {}
+        self.ms = {}
+        self.constraints = {}
+        self.properties = {}
+        self.rsc_defaults = {}
+
+        configuration = self.root.find('configuration')
+        if configuration is None:
+            return
+
+        resources = configuration.find('resources')
+        if resources is not None:
+            for elem in resources.iter():
+                index = self.RESOURCE_TAGS.get(elem.tag)
+                if index and elem.get('id'):
+                    getattr(self, index)[elem.get('id')] = elem
+
+        constraints = configuration.find('constraints')
+        if constraints is not None:
+            for elem in constraints:
+                if elem.tag in self.CONSTRAINT_TAGS and elem.get('id'):
+                    self.constraints[elem.get('id')] = elem
+
+        for nvpair in configuration.findall('crm_config/'
+                                            'cluster_property_set/nvpair'):
+            self.properties[nvpair.get('name')] = nvpair.get('value')
+
+        for nvpair in configuration.findall('rsc_defaults/'
+                                            'meta_attributes/nvpair'):
+            self.rsc_defaults[nvpair.get('name')] = nvpair.get('value')
+
+    def __contains__(self, obj_id):
+        return self.get(obj_id) is not None
+
+    def params(self, obj_id):
+        """Return the instance attributes of a resource as a dict"""
+        elem = self.get(obj_id)
+        if elem is None:
+            return {}
+
+        return dict((nvpair.get('name'), nvpair.get('value')) for nvpair in
+                    elem.findall('instance_attributes/nvpair'))
+
+    def get(self, obj_id):
+        """Return the XML element for a resource or constraint id"""
+        for index in (self.primitives, self.groups, self.clones, self.ms,
+                      self.constraints):
+            if obj_id in index:
+                return index[obj_id]
+
+        return None
+
+
+def set_property(name, value):
+    """Set a cluster property unless it already has the requested value
+
+    @returns boolean - True if the property was written
+    """
+    if get_cib().properties.get(name) == value:
+        return False
 
+    commit('crm configure property %s=%s' % (name, value))
+    return True
 
-def commit(cmd):
-    subprocess.call(cmd.split())
 
+def set_rsc_default(name, value):
+    """Set a resource default unless it already has the requested value
 
-def is_resource_present(resource):
-    status = commands.getstatusoutput("crm resource status %s" % resource)[0]
-    if status != 0:
+    @returns boolean - True if the default was written
+    """
+    if get_cib().rsc_defaults.get(name) == value:
         return False
 
+    commit('crm configure rsc_defaults $id="rsc-options" %s="%s"' %
+           (name, value))
     return True
 
 
+def get_cib():
+    """Return the current CIB snapshot, querying the cluster if needed
+
+    The snapshot is reused until invalidate_cib() is called, which commit()
+    does after every change made to the cluster.
+    """
+    global _cib
+    if _cib is None:
+        try:
+            _cib = CIB(subprocess.check_output(['cibadmin', '-Q']))
+        except subprocess.CalledProcessError:
+            log('Unable to query the CIB', WARNING)
+            return CIB('<cib/>')
+
+    return _cib
+
+
+def invalidate_cib():
+    global _cib
+    _cib = None
+
+
+class ConfigBatch(object):
+    """Collect crm configure statements and apply them in one CIB update.
+
+    Statements use the crm shell syntax (e.g. 'primitive res_foo
+    ocf:heartbeat:IPaddr2 params ip=10.0.0.10') and are loaded together with
+    'crm configure load update', so the cluster only has to settle once
+    rather than once per object.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def add(self, statement):
+        self.statements.append(statement)
+
+    def commit(self):
+        """Apply all collected statements
+
+        @returns boolean - True if anything was sent to the cluster
+        @raises CalledProcessError if the cluster rejected the update
+        """
+        if not self.statements:
+            return False
+
+        with tempfile.NamedTemporaryFile(prefix='crm-batch-',
+                                         suffix='.crm') as batch:
+            batch.write('\n'.join(self.statements) + '\n')
+            batch.flush()
+            commit('crm -w -F configure load update %s' % batch.name,
+                   failure_is_fatal=True)
+
+        self.statements = []
+        return True
+
+
+def reconcile(desired, applied, cib=None):
+    """Work out the changes needed to bring the cluster to a desired state
+
+    @param desired: dict of object id -> crm configure statement wanted
+    @param applied: dict of object id -> crm configure statement last applied
+                    by the charm
+    @param cib: CIB snapshot to compare with, defaults to get_cib()
+    @returns (create, update, delete) - sorted lists of object ids
+    """
+    if cib is None:
+        cib = get_cib()
+
+    create = []
+    update = []
+    for obj_id, stmt in desired.iteritems():
+        if obj_id not in cib:
+            create.append(obj_id)
+        elif applied.get(obj_id) != stmt:
+            update.append(obj_id)
+
+    delete = [obj_id for obj_id in applied
+              if obj_id not in desired and obj_id in cib]
+
+    return sorted(create), sorted(update), sorted(delete)
+
+
+def delete_objects(obj_ids):
+    """Stop and delete the given configuration objects in one CIB update
+
+    Objects which are not present in the CIB are ignored.
+
+    @returns list of object ids deleted
+    @raises CalledProcessError if stopping or deleting an object failed
+    """
+    deletes = []
+    for obj_id in obj_ids:
+        if crm_opt_exists(obj_id):
+            log('Stopping and deleting resource %s' % obj_id)
+            if crm_res_running(obj_id):
+                commit('crm -w -F resource stop %s' % obj_id,
+                       failure_is_fatal=True)
+            deletes.append(obj_id)
+
+    if deletes:
+        commit('crm -w -F configure delete %s' % ' '.join(deletes),
+               failure_is_fatal=True)
+
+    return deletes
+
+
+class ClusterStatus(object):
+    """Node and resource state parsed from one crm_mon XML snapshot
+
+    Every query is answered from memory; call refresh() to take a new
+    snapshot.
+    """
+
+    RUNNING_ROLES = ['Started', 'Master', 'Slave']
+
+    def __init__(self, xml=None):
+        if xml is None:
+            self.refresh()
+        else:
+            self._parse(xml)
+
+    def refresh(self):
+        self._parse(subprocess.check_output(['crm_mon', '-X', '-r', '-f']))
+
+    def _parse(self, xml):
+        self.root = ET.fromstring(xml)
+        self.nodes = {}
+        # resource id -> list of instances, each a dict with 'role',
+        # 'active', 'failed' and the 'nodes' it is running on
+        self.instances = {}
+        # group/clone/ms id -> ids of the resources they contain
+        self.members = {}
+        # ids of the resources running as clone or master/slave instances
+        self.cloned = set()
+        # (resource id, node name) -> fail count
+        self.failcounts = {}
+
+        for node in self.root.findall('nodes/node'):
+            self.nodes[node.get('name')] = node.attrib
+
+        resources = self.root.find('resources')
+        if resources is not None:
+            self._parse_resources(resources, [])
+
+        for node in self.root.findall('node_history/node'):
+            for history in node.findall('resource_history'):
+                rsc_id = history.get('id').split(':')[0]
+                key = (rsc_id, node.get('name'))
+                self.failcounts[key] = (self.failcounts.get(key, 0) +
+                                        int(history.get('fail-count', 0)))
+
+    def _parse_resources(self, elem, parents, cloned=False):
+        for child in elem:
+            if child.tag == 'resource':
+                # anonymous clone instances share the id of the primitive,
+                # unique ones get a ':<n>' suffix
+                rsc_id = child.get('id').split(':')[0]
+                self.instances.setdefault(rsc_id, []).append({
+                    'role': child.get('role'),
+                    'active': child.get('active') == 'true',
+                    'failed': child.get('failed') == 'true',
+                    'nodes': [n.get('name') for n in child.findall('node')],
+                })
+                for parent in parents:
+                    members = self.members.setdefault(parent, [])
+                    if rsc_id not in members:
+                        members.append(rsc_id)
+                if cloned:
+                    self.cloned.add(rsc_id)
+            elif child.get('id'):
+                self.members.setdefault(child.get('id'), [])
+                self._parse_resources(child, parents + [child.get('id')],
+                                      cloned or child.tag == 'clone')
+
+    def _instances(self, name):
+        if name in self.members:
+            return [i for rsc_id in self.members[name]
+                    for i in self.instances.get(rsc_id, [])]
+
+        return self.instances.get(name, [])
+
+    def has_resource(self, name):
+        return name in self.instances or name in self.members
+
+    def is_running(self, name):
+        """Check if a resource, or any member of a group/clone, is running"""
+        return any(i['active'] and i['role'] in self.RUNNING_ROLES
+                   for i in self._instances(name))
+
+    def locations(self, name):
+        """Return the sorted node names a resource is running on"""
+        return sorted(set(node for i in self._instances(name)
+                          if i['active'] for node in i['nodes']))
+
+    def roles(self, name):
+        """Return a dict of node name -> role of a resource"""
+        return dict((node, i['role']) for i in self._instances(name)
+                    for node in i['nodes'])
+
+    def failcount(self, name, node=None):
+        """Return the fail count of a resource, on one node or in total"""
+        rsc_ids = self.members.get(name) or [name]
+        return sum(count for (rsc_id, node_name), count in
+                   self.failcounts.iteritems()
+                   if rsc_id in rsc_ids and node in (None, node_name))
+
+    def is_online(self, node):
+        return self.nodes.get(node, {}).get('online') == 'true'
+
+    def is_standby(self, node):
+        return self.nodes.get(node, {}).get('standby') == 'true'
+
+    def is_cloned(self, name):
+        """Check if a resource runs as clone (or master/slave) instances"""
+        return name in self.cloned or any(
+            rsc_id in self.cloned for rsc_id in self.members.get(name, []))
+
+    def stopped_instances(self, name):
+        """Return the number of instances of a resource which are not active
+        """
+        return len([i for i in self._instances(name) if not i['active']])
+
+    def resources_on(self, node):
+        """Return the sorted ids of the resources running on a node"""
+        return sorted(rsc_id for rsc_id, instances in
+                      self.instances.iteritems()
+                      if any(i['active'] and node in i['nodes']
+                             for i in instances))
+
+
+def get_cluster_status():
+    """Return the current ClusterStatus, querying the cluster if needed
+
+    Like get_cib(), the snapshot is reused until commit() changes the
+    cluster.
+    """
+    global _cluster_status
+    if _cluster_status is None:
+        try:
+            _cluster_status = ClusterStatus()
+        except subprocess.CalledProcessError:
+            log('Unable to query the cluster status', WARNING)
+            return ClusterStatus('<crm_mon/>')
+
+    return _cluster_status
+
+
+def invalidate_cluster_status():
+    global _cluster_status
+    _cluster_status = None
+
+
+def is_resource_present(resource):
+    return get_cluster_status().has_resource(resource)
+
+
 def standby(node=None):
     if node is None:
         cmd = "crm -F node standby"
@@ -47,19 +458,11 @@ def online(node=None):
 
 
 def crm_opt_exists(opt_name):
-    output = commands.getstatusoutput("crm configure show")[1]
-    if opt_name in output:
-        return True
-
-    return False
+    return opt_name in get_cib()
 
 
 def crm_res_running(opt_name):
-    (_, output) = commands.getstatusoutput("crm resource status %s" % opt_name)
-    if output.startswith("resource %s is running" % opt_name):
-        return True
-
-    return False
+    return get_cluster_status().is_running(opt_name)
 
 
 def list_nodes():
@@ -88,12 +491,28 @@ def _maas_ipmi_stonith_resource(node, power_params):
     return rsc, constraint
 
 
+def index_maas_nodes(maas_nodes):
+    """Index a MAAS node inventory by short hostname
+
+    @param maas_nodes: list of MAAS node dicts
+    @returns dict of hostname (without domain) -> node dict
+    """
+    return dict((node['hostname'].split('.')[0], node)
+                for node in maas_nodes)
+
+
 def maas_stonith_primitive(maas_nodes, crm_node):
+    """Build the STONITH primitive and constraint for a cluster node
+
+    @param maas_nodes: MAAS node inventory as returned by index_maas_nodes()
+    @param crm_node: name of the pacemaker node
+    @returns (primitive, constraint) crm statements or (False, False)
+    """
     power_type = power_params = None
-    for node in maas_nodes:
-        if node['hostname'].startswith(crm_node):
-            power_type = node['power_type']
-            power_params = node['power_parameters']
+    node = maas_nodes.get(crm_node)
+    if node:
+        power_type = node['power_type']
+        power_params = node['power_parameters']
 
     if not power_type or not power_params:
         return False, False
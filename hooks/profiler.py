@@ -0,0 +1,105 @@
+#
+# Copyright 2016 Canonical Ltd.
+#
+import functools
+import subprocess
+import time
+
+from charmhelpers.core.unitdata import kv
+
+# kv key prefix under which the latest run of each hook is stored
+PROFILE_KEY_PREFIX = 'profile.'
+WRAPPED_FUNCTIONS = ['call', 'check_call', 'check_output']
+
+_records = []
+_originals = {}
+_depth = [0]
+
+
+def _command(args, kwargs):
+    cmd = args[0] if args else kwargs.get('args')
+    if isinstance(cmd, (list, tuple)):
+        cmd = ' '.join(str(arg) for arg in cmd)
+
+    return cmd
+
+
+def _wrap(name, func):
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        # check_call is implemented with call, only record the outer one
+        _depth[0] += 1
+        start = time.time()
+        rc = None
+        try:
+            result = func(*args, **kwargs)
+            rc = result if name == 'call' else 0
+            return result
+        except subprocess.CalledProcessError as e:
+            rc = e.returncode
+            raise
+        finally:
+            _depth[0] -= 1
+            if _depth[0] == 0:
+                _records.append({'cmd': _command(args, kwargs),
+                                 'duration': time.time() - start,
+                                 'rc': rc})
+    return wrapped
+
+
+def enable():
+    """Start recording the wall time of every subprocess call
+
+    subprocess is patched at module level, so this covers the commands run
+    by pcmk.commit as well as the hook tools and apt commands run through
+    charmhelpers.
+    """
+    if _originals:
+        return
+
+    for name in WRAPPED_FUNCTIONS:
+        _originals[name] = getattr(subprocess, name)
+        setattr(subprocess, name, _wrap(name, _originals[name]))
+
+
+def disable():
+    for name, func in _originals.items():
+        setattr(subprocess, name, func)
+
+    _originals.clear()
+
+
+def save(hook_name):
+    """Store the commands recorded so far as the latest run of a hook"""
+    if not _originals:
+        return
+
+    records = list(_records)
+    del _records[:]
+    db = kv()
+    db.set(PROFILE_KEY_PREFIX + hook_name,
+           {'started': time.time(),
+            'total': sum(r['duration'] for r in records),
+            'records': records})
+    db.flush()
+
+
+def summary(count=10):
+    """Summarise the recorded hook runs
+
+    @param count: number of slowest commands to report per hook
+    @returns dict of hook name -> dict with the total time, the number of
+             commands run and the slowest commands
+    """
+    hooks = {}
+    profiles = kv().getrange(PROFILE_KEY_PREFIX, strip=True)
+    for hook_name, profile in profiles.items():
+        records = sorted(profile['records'], key=lambda r: r['duration'],
+                         reverse=True)
+        hooks[hook_name] = {
+            'total': profile['total'],
+            'commands': len(records),
+            'slowest': records[:count],
+        }
+
+    return hooks
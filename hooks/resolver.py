@@ -0,0 +1,105 @@
+#
+# Copyright 2016 Canonical Ltd.
+#
+import socket
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from charmhelpers.core.hookenv import (
+    log,
+    WARNING,
+)
+from charmhelpers.core.unitdata import kv
+from charmhelpers.contrib.network.ip import is_ip
+from charmhelpers.fetch import apt_install
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    apt_install('python-dnspython', fatal=True)
+    import dns.exception
+    import dns.resolver
+
+DNS_CACHE_KEY = 'hacluster-dns-cache'
+# addresses from gethostbyname come without a TTL, keep them this long (s)
+FALLBACK_TTL = 300
+MAX_WORKERS = 8
+
+
+def _query(hostname):
+    """Resolve a hostname to an IPv4 address
+
+    @returns tuple of the address and the number of seconds it may be
+             cached for, or (None, 0) if the hostname does not resolve
+    """
+    try:
+        answers = dns.resolver.query(hostname, 'A')
+        return str(answers[0]), answers.rrset.ttl
+    except dns.exception.DNSException:
+        pass
+
+    try:
+        return socket.gethostbyname(hostname), FALLBACK_TTL
+    except (socket.error, UnicodeError):
+        log("Failed to resolve hostname '%s'" % hostname, level=WARNING)
+        return None, 0
+
+
+def resolve_hosts(hostnames, max_workers=MAX_WORKERS):
+    """Resolve a list of hostnames to IPv4 addresses
+
+    Addresses are given back as they are, names are looked up once each in
+    a bounded pool of threads. Results are kept in the unit's kv store for
+    the TTL of their DNS record so later calls and hooks reuse them.
+
+    @param hostnames: iterable of hostnames or addresses, None is ignored
+    @param max_workers: maximum number of concurrent lookups
+    @returns dict of hostname -> address, or None if it did not resolve
+    """
+    now = time.time()
+    db = kv()
+    cache = db.get(DNS_CACHE_KEY) or {}
+
+    results = {}
+    pending = set()
+    for host in hostnames:
+        if not host:
+            continue
+        elif is_ip(host):
+            results[host] = host
+        elif host in cache and cache[host]['expires'] > now:
+            results[host] = cache[host]['addr']
+        else:
+            pending.add(host)
+
+    if not pending:
+        return results
+
+    pending = sorted(pending)
+    pool = ThreadPool(min(max_workers, len(pending)))
+    try:
+        answers = pool.map(_query, pending)
+    finally:
+        pool.close()
+        pool.join()
+
+    cache = dict((host, entry) for host, entry in cache.items()
+                 if entry['expires'] > now)
+    for host, (addr, ttl) in zip(pending, answers):
+        results[host] = addr
+        if addr:
+            cache[host] = {'addr': addr, 'expires': now + ttl}
+
+    db.set(DNS_CACHE_KEY, cache)
+    db.flush()
+    return results
+
+
+def get_host_ip(hostname, fallback=None):
+    """Resolve a single hostname through the shared cache
+
+    @returns the address of hostname, or fallback if it did not resolve
+    """
+    return resolve_hosts([hostname]).get(hostname) or fallback
@@ -1,23 +1,33 @@
 #!/usr/bin/python
 import ast
+import hashlib
+import json
 import pcmk
 import maas
+import netmath
+import resolver
 import os
+import shutil
 import subprocess
 import socket
-import fcntl
-import struct
+import time
+import uuid
 import xml.etree.ElementTree as ET
 
 from base64 import b64decode
 
 from charmhelpers.core.hookenv import (
+    cached,
     local_unit,
     log,
     DEBUG,
     INFO,
     WARNING,
+    is_leader,
+    leader_get,
+    leader_set,
     relation_get,
+    relation_set,
     related_units,
     relation_ids,
     config,
@@ -25,7 +35,6 @@ from charmhelpers.core.hookenv import (
     status_set,
 )
 from charmhelpers.contrib.openstack.utils import (
-    get_host_ip,
     set_unit_paused,
     clear_unit_paused,
     is_unit_paused_set,
@@ -37,14 +46,13 @@ from charmhelpers.core.host import (
     service_running,
     write_file,
     file_hash,
+    init_is_systemd,
     lsb_release
 )
+from charmhelpers.core.unitdata import kv
 from charmhelpers.fetch import (
     apt_install,
 )
-from charmhelpers.contrib.hahelpers.cluster import (
-    peer_ips,
-)
 from charmhelpers.contrib.network import ip as utils
 
 try:
@@ -53,12 +61,6 @@ except ImportError:
     apt_install('python-netifaces')
     import netifaces
 
-try:
-    from netaddr import IPNetwork
-except ImportError:
-    apt_install('python-netaddr', fatal=True)
-    from netaddr import IPNetwork
-
 
 try:
     import jinja2
@@ -80,6 +82,51 @@ COROSYNC_CONF_FILES = [
     COROSYNC_HACLUSTER_ACL,
 ]
 SUPPORTED_TRANSPORTS = ['udp', 'udpu', 'multicast', 'unicast']
+SUPPORTED_RRP_MODES = ['active', 'passive']
+RELATION_SNAPSHOT_KEY = 'hacluster-relation-snapshot'
+RESTART_PENDING_KEY = 'corosync-restart-pending'
+# set once corosync was restarted for the pending request, until the node
+# rejoined the cluster
+RESTART_REJOIN_KEY = 'corosync-restart-rejoin'
+# why the pending restart is waiting, reported as workload status
+RESTART_REASON_KEY = 'corosync-restart-reason'
+# leader setting naming the only unit allowed to restart, '<unit>:<token>'
+RESTART_LOCK_KEY = 'corosync-restart-lock'
+# seconds a hook waits for pacemaker to rejoin before deferring to the next
+RESTART_REJOIN_TIMEOUT = 30
+# resources running on the unit when it was paused
+PAUSED_RESOURCES_KEY = 'hacluster-paused-resources'
+# Totem timings (ms) and flow control settings per corosync_profile; a None
+# value leaves the corosync default in place.
+COROSYNC_PROFILES = {
+    'lan-fast': {'token': 1000, 'consensus': 1200, 'join': 50,
+                 'max_messages': 20, 'window_size': None, 'send_join': None},
+    'default': {'token': 3000, 'consensus': 3600, 'join': 60,
+                'max_messages': 20, 'window_size': None, 'send_join': None},
+    'wan': {'token': 10000, 'consensus': 12000, 'join': 1000,
+            'max_messages': 17, 'window_size': 50, 'send_join': 80},
+}
+# corosync's own default when window_size is not set
+COROSYNC_DEFAULT_WINDOW_SIZE = 50
+# corosync crypto_cipher/crypto_hash values and the matching OpenSSL EVP
+# algorithm used to estimate their cost
+COROSYNC_CRYPTO_CIPHERS = {
+    'aes256': 'aes-256-cbc',
+    'aes192': 'aes-192-cbc',
+    'aes128': 'aes-128-cbc',
+    '3des': 'des-ede3-cbc',
+}
+COROSYNC_CRYPTO_HASHES = {
+    'md5': 'md5',
+    'sha1': 'sha1',
+    'sha256': 'sha256',
+    'sha384': 'sha384',
+    'sha512': 'sha512',
+}
+METRICS_EXPORTER = '/usr/local/bin/hacluster-exporter'
+METRICS_EXPORTER_SERVICE = 'hacluster-exporter'
+# corosync.conf sections applied by 'corosync-cfgtool -R'
+COROSYNC_RELOADABLE_SECTIONS = ['nodelist', 'logging']
 
 
 def disable_upstart_services(*services):
@@ -105,39 +152,60 @@ def enable_lsb_services(*services):
         subprocess.check_call(['update-rc.d', '-f', service, 'defaults'])
 
 
+@cached
+def get_iface_addresses():
+    """Return the addresses configured on every network interface
+
+    All interfaces are read in a single netifaces pass and the result is
+    cached for the rest of the hook.
+
+    @returns dict of interface name -> {'ipv4': [...], 'ipv6': [...]} where
+             each entry is a dict with the 'addr' and its 'netmask'
+    """
+    inventory = {}
+    for iface in netifaces.interfaces():
+        addresses = netifaces.ifaddresses(iface)
+        inventory[iface] = {'ipv4': [], 'ipv6': []}
+        for family, key in [(netifaces.AF_INET, 'ipv4'),
+                            (netifaces.AF_INET6, 'ipv6')]:
+            for addr in addresses.get(family, []):
+                if not addr.get('addr'):
+                    continue
+
+                # drop the scope of link-local addresses (fe80::1%eth0) and
+                # the prefix length newer netifaces append to the mask
+                inventory[iface][key].append(
+                    {'addr': addr['addr'].split('%')[0],
+                     'netmask': addr.get('netmask', '').split('/')[0]})
+
+    return inventory
+
+
+def _get_iface_ipv4(iface):
+    addresses = get_iface_addresses().get(iface, {}).get('ipv4')
+    if not addresses:
+        raise IOError("No IPv4 address found on interface '%s'" % iface)
+
+    return addresses[0]
+
+
 def get_iface_ipaddr(iface):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(
-        s.fileno(),
-        0x8919,  # SIOCGIFADDR
-        struct.pack('256s', iface[:15])
-    )[20:24])
+    return _get_iface_ipv4(iface)['addr']
 
 
 def get_iface_netmask(iface):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    return socket.inet_ntoa(fcntl.ioctl(
-        s.fileno(),
-        0x891b,  # SIOCGIFNETMASK
-        struct.pack('256s', iface[:15])
-    )[20:24])
+    return _get_iface_ipv4(iface)['netmask']
 
 
 def get_netmask_cidr(netmask):
-    netmask = netmask.split('.')
-    binary_str = ''
-    for octet in netmask:
-        binary_str += bin(int(octet))[2:].zfill(8)
-    return str(len(binary_str.rstrip('0')))
+    return str(netmath.netmask_to_prefixlen(netmask))
 
 
 def get_network_address(iface):
     if iface:
         iface = str(iface)
-        network = "{}/{}".format(get_iface_ipaddr(iface),
-                                 get_netmask_cidr(get_iface_netmask(iface)))
-        ip = IPNetwork(network)
-        return str(ip.network)
+        return netmath.network_address(get_iface_ipaddr(iface),
+                                       get_iface_netmask(iface))
     else:
         return None
 
@@ -149,12 +217,10 @@ def get_ipv6_network_address(iface):
 
     try:
         ipv6_addr = utils.get_ipv6_addr(iface=iface)[0]
-        all_addrs = netifaces.ifaddresses(iface)
 
-        for addr in all_addrs[netifaces.AF_INET6]:
+        for addr in get_iface_addresses().get(iface, {}).get('ipv6', []):
             if ipv6_addr == addr['addr']:
-                network = "{}/{}".format(addr['addr'], addr['netmask'])
-                return str(IPNetwork(network).network)
+                return netmath.network_address(addr['addr'], addr['netmask'])
 
     except ValueError:
         msg = "Invalid interface '%s'" % iface
@@ -178,6 +244,189 @@ def nulls(data):
             if not isinstance(data[k], bool) and not data[k]]
 
 
+def get_totem_settings():
+    """Return the totem settings for the configured profile and overrides
+
+    @returns dict of totem option -> value
+    @raises ValueError if the profile is unknown or the values do not
+            make sense together
+    """
+    profile = config('corosync_profile') or 'default'
+    if profile not in COROSYNC_PROFILES:
+        msg = ("Unsupported corosync_profile '%s' - supported profiles "
+               "are: %s" % (profile, ', '.join(sorted(COROSYNC_PROFILES))))
+        status_set('blocked', msg)
+        raise ValueError(msg)
+
+    totem = dict(COROSYNC_PROFILES[profile])
+    overrides = set()
+    for option in totem:
+        value = config('corosync_%s' % option)
+        if value is not None:
+            totem[option] = value
+            overrides.add(option)
+
+    # like corosync itself, derive consensus from an overridden token
+    # unless it is set as well
+    if 'token' in overrides and 'consensus' not in overrides:
+        totem['consensus'] = int(1.2 * totem['token'])
+
+    # the profiles are consistent, only check what the operator set
+    errors = []
+    if any(totem[option] < 0 for option in overrides):
+        errors.append('totem settings must not be negative')
+    if ('consensus' in overrides and
+            totem['consensus'] < 1.2 * totem['token']):
+        errors.append('consensus (%s) must be at least 1.2 * token (%s)' %
+                      (totem['consensus'], totem['token']))
+    if (overrides & set(['join', 'consensus', 'token']) and
+            totem['join'] >= totem['consensus']):
+        errors.append('join (%s) must be smaller than consensus (%s)' %
+                      (totem['join'], totem['consensus']))
+    window_size = totem['window_size'] or COROSYNC_DEFAULT_WINDOW_SIZE
+    if (overrides & set(['max_messages', 'window_size']) and
+            totem['max_messages'] > window_size):
+        errors.append('max_messages (%s) must not exceed window_size (%s)' %
+                      (totem['max_messages'], window_size))
+
+    if errors:
+        msg = 'Invalid corosync totem settings: %s' % '; '.join(errors)
+        status_set('blocked', msg)
+        raise ValueError(msg)
+
+    return totem
+
+
+def get_ring1_address():
+    """Return this unit's address on the second corosync ring, if any"""
+    iface = config('corosync_ring1_bindiface')
+    if not iface:
+        return None
+
+    if config('prefer-ipv6'):
+        return utils.get_ipv6_addr(iface=iface)[0]
+
+    return get_iface_ipaddr(str(iface))
+
+
+def get_ring1_conf(bindnetaddr):
+    """Build the configuration of the redundant (second) corosync ring
+
+    Every node needs an address on the second ring, which peers publish as
+    ring1-address on the hanode relation. The ring is left out until all
+    of them have done so.
+
+    @param bindnetaddr: function returning the network address of an
+                        interface
+    @returns dict describing ring 1, or None if it is not configured
+    """
+    iface = config('corosync_ring1_bindiface')
+    if not iface:
+        return None
+
+    rrp_mode = config('corosync_rrp_mode')
+    if rrp_mode not in SUPPORTED_RRP_MODES:
+        msg = ("Unsupported corosync_rrp_mode '%s' - supported modes are: "
+               "%s" % (rrp_mode, ', '.join(SUPPORTED_RRP_MODES)))
+        status_set('blocked', msg)
+        raise ValueError(msg)
+
+    nodes = {get_corosync_id(local_unit()): get_ring1_address()}
+    for unit, addr in peer_ips(addr_key='ring1-address').iteritems():
+        if not addr:
+            log('No ring1 address from %s yet, not configuring the '
+                'redundant ring' % unit, level=INFO)
+            return None
+
+        nodes[get_corosync_id(unit)] = addr
+
+    return {
+        'rrp_mode': rrp_mode,
+        'bindnetaddr': bindnetaddr(iface),
+        'mcastaddr': config('corosync_ring1_mcastaddr'),
+        'nodes': nodes,
+    }
+
+
+def get_crypto_settings():
+    """Return the corosync encryption settings from the charm config
+
+    @returns dict with the cipher, hash and number of crypto threads
+    @raises ValueError if the settings are not supported by corosync
+    """
+    cipher = config('corosync_crypto_cipher') or 'none'
+    hash_ = config('corosync_crypto_hash') or 'none'
+    threads = config('corosync_threads') or 0
+
+    errors = []
+    if cipher != 'none' and cipher not in COROSYNC_CRYPTO_CIPHERS:
+        errors.append("unsupported crypto cipher '%s'" % cipher)
+    if hash_ != 'none' and hash_ not in COROSYNC_CRYPTO_HASHES:
+        errors.append("unsupported crypto hash '%s'" % hash_)
+    if cipher != 'none' and hash_ == 'none':
+        errors.append('a crypto hash is required when a cipher is set')
+    if threads < 0:
+        errors.append('crypto threads must not be negative')
+
+    if errors:
+        msg = 'Invalid corosync crypto settings: %s' % '; '.join(errors)
+        status_set('blocked', msg)
+        raise ValueError(msg)
+
+    return {'cipher': cipher, 'hash': hash_, 'threads': threads}
+
+
+def openssl_throughput(algorithm):
+    """Measure how fast OpenSSL processes data with an EVP algorithm
+
+    @param algorithm: OpenSSL EVP algorithm name, e.g. aes-256-cbc
+    @returns dict of block size (bytes) -> throughput (bytes per second)
+    """
+    with open(os.devnull, 'w') as devnull:
+        out = subprocess.check_output(['openssl', 'speed', '-mr', '-evp',
+                                       algorithm], stderr=devnull)
+
+    sizes = []
+    for line in out.splitlines():
+        # '+H:16:64:...' lists the block sizes and '+F:<n>:<algorithm>:...'
+        # the bytes processed per second for each of them
+        if line.startswith('+H:'):
+            sizes = [int(size) for size in line.split(':')[1:]]
+        elif line.startswith('+F:'):
+            rates = [float(rate) for rate in line.split(':')[3:]]
+            return dict(zip(sizes, rates))
+
+    return {}
+
+
+def estimate_crypto_cost(message_size=1500):
+    """Estimate the per-message cost of each corosync crypto setting
+
+    Corosync encrypts and signs with NSS, not OpenSSL, and adds its own
+    framing, so this is only an indication of how the settings compare on
+    the local CPU (e.g. whether AES-NI makes aes256 cheap), not the totem
+    throughput corosync achieves.
+
+    @param message_size: size of a totem message in bytes
+    @returns dict of 'cipher'/'hash' -> setting -> (throughput in bytes
+             per second, microseconds per message)
+    """
+    results = {'cipher': {}, 'hash': {}}
+    for kind, algorithms in [('cipher', COROSYNC_CRYPTO_CIPHERS),
+                             ('hash', COROSYNC_CRYPTO_HASHES)]:
+        for setting, algorithm in algorithms.iteritems():
+            rates = openssl_throughput(algorithm)
+            # use the largest block size measured that fits in a message
+            sizes = [size for size in rates if size <= message_size]
+            if not sizes:
+                continue
+
+            rate = rates[max(sizes)]
+            results[kind][setting] = (rate, message_size * 1e6 / rate)
+
+    return results
+
+
 def get_corosync_conf():
     if config('prefer-ipv6'):
         ip_version = 'ipv6'
@@ -196,6 +445,8 @@ def get_corosync_conf():
         'ip_version': ip_version,
         'ha_nodes': get_ha_nodes(),
         'transport': get_transport(),
+        'totem': get_totem_settings(),
+        'crypto': get_crypto_settings(),
     }
 
     if config('prefer-ipv6'):
@@ -207,6 +458,10 @@ def get_corosync_conf():
     if config('debug'):
         conf['debug'] = config('debug')
 
+    ring1 = get_ring1_conf(bindnetaddr)
+    if ring1:
+        conf['ring1'] = ring1
+
     if not nulls(conf):
         log("Found sufficient values in local config to populate "
             "corosync.conf", level=DEBUG)
@@ -215,16 +470,17 @@ def get_corosync_conf():
     conf = {}
     for relid in relation_ids('ha'):
         for unit in related_units(relid):
-            bindiface = relation_get('corosync_bindiface',
-                                     unit, relid)
+            settings = relation_settings(relid, unit)
+            bindiface = settings.get('corosync_bindiface')
             conf = {
                 'corosync_bindnetaddr': bindnetaddr(bindiface),
-                'corosync_mcastport': relation_get('corosync_mcastport',
-                                                   unit, relid),
+                'corosync_mcastport': settings.get('corosync_mcastport'),
                 'corosync_mcastaddr': config('corosync_mcastaddr'),
                 'ip_version': ip_version,
                 'ha_nodes': get_ha_nodes(),
                 'transport': get_transport(),
+                'totem': get_totem_settings(),
+                'crypto': get_crypto_settings(),
             }
 
             if config('prefer-ipv6'):
@@ -236,6 +492,10 @@ def get_corosync_conf():
             if config('debug'):
                 conf['debug'] = config('debug')
 
+            ring1 = get_ring1_conf(bindnetaddr)
+            if ring1:
+                conf['ring1'] = ring1
+
             # Values up to this point must be non-null
             if nulls(conf):
                 continue
@@ -279,6 +539,70 @@ def emit_base_conf():
     return False
 
 
+def metrics_exporter_service():
+    """Return the service file and template of the exporter for this init"""
+    if init_is_systemd():
+        return ('/etc/systemd/system/%s.service' % METRICS_EXPORTER_SERVICE,
+                'hacluster-exporter.service')
+
+    return ('/etc/init/%s.conf' % METRICS_EXPORTER_SERVICE,
+            'hacluster-exporter.conf')
+
+
+def remove_metrics_exporter():
+    """Stop the Prometheus exporter and remove its service"""
+    service_file, _ = metrics_exporter_service()
+    if os.path.exists(service_file):
+        service_stop(METRICS_EXPORTER_SERVICE)
+        if init_is_systemd():
+            subprocess.check_call(['systemctl', 'disable',
+                                   METRICS_EXPORTER_SERVICE])
+        os.remove(service_file)
+        if init_is_systemd():
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+
+    if os.path.exists(METRICS_EXPORTER):
+        os.remove(METRICS_EXPORTER)
+
+
+def configure_metrics_exporter():
+    """Install and start the Prometheus exporter on the metrics_port
+
+    It listens on metrics_address only. The exporter is stopped and its
+    service removed when metrics_port is 0.
+
+    @returns the port the exporter listens on or None if it is disabled
+    """
+    service_file, template = metrics_exporter_service()
+    port = config('metrics_port')
+    if not port:
+        remove_metrics_exporter()
+        return None
+
+    checksums = [file_hash(path) for path in [METRICS_EXPORTER, service_file]]
+    shutil.copy2(os.path.join(os.environ.get('CHARM_DIR', ''), 'files',
+                              'exporter', 'hacluster-exporter'),
+                 METRICS_EXPORTER)
+    write_file(service_file,
+               render_template(template, {
+                   'exporter': METRICS_EXPORTER,
+                   'address': config('metrics_address') or '127.0.0.1',
+                   'port': port}),
+               perms=0o644)
+    if init_is_systemd():
+        subprocess.check_call(['systemctl', 'daemon-reload'])
+        subprocess.check_call(['systemctl', 'enable',
+                               METRICS_EXPORTER_SERVICE])
+
+    if not service_running(METRICS_EXPORTER_SERVICE):
+        service_start(METRICS_EXPORTER_SERVICE)
+    elif checksums != [file_hash(path)
+                       for path in [METRICS_EXPORTER, service_file]]:
+        service_restart(METRICS_EXPORTER_SERVICE)
+
+    return port
+
+
 def render_template(template_name, context, template_dir=TEMPLATES_DIR):
     templates = jinja2.Environment(
         loader=jinja2.FileSystemLoader(template_dir)
@@ -311,7 +635,7 @@ def get_transport():
 
 def get_ipv6_addr():
     """Exclude any ip addresses configured or managed by corosync."""
-    excludes = []
+    excludes = set()
     for rid in relation_ids('ha'):
         for unit in related_units(rid):
             resources = parse_data(rid, unit, 'resources')
@@ -324,14 +648,37 @@ def get_ipv6_addr():
                             if utils.is_ipv6(v):
                                 log("Excluding '%s' from address list" % v,
                                     level=DEBUG)
-                                excludes.append(v)
+                                excludes.add(v)
+
+    # Only addresses within one of the local prefixes can be configured on
+    # this unit; match them all in one pass and in the canonical form
+    # netifaces reports them in.
+    local_networks = [(addr['addr'], addr['netmask'])
+                      for iface in get_iface_addresses().values()
+                      for addr in iface['ipv6'] if addr['netmask']]
+    excludes = netmath.addresses_in_networks(excludes, local_networks)
 
     return utils.get_ipv6_addr(exc_list=excludes)[0]
 
 
+def peer_ips(peer_relation='hanode', addr_key='private-address'):
+    """Return a dict of peer units and their address"""
+    peers = {}
+    for relid in relation_ids(peer_relation):
+        for unit in related_units(relid):
+            peers[unit] = relation_settings(relid, unit).get(addr_key)
+
+    return peers
+
+
 def get_ha_nodes():
     ha_units = peer_ips(peer_relation='hanode')
     ha_nodes = {}
+    if not config('prefer-ipv6'):
+        # resolve every peer (and this unit) in one concurrent, cached pass
+        addrs = resolver.resolve_hosts(list(ha_units.values()) +
+                                       [unit_get('private-address')])
+
     for unit in ha_units:
         corosync_id = get_corosync_id(unit)
         addr = ha_units[unit]
@@ -343,13 +690,13 @@ def get_ha_nodes():
 
             ha_nodes[corosync_id] = addr
         else:
-            ha_nodes[corosync_id] = get_host_ip(addr)
+            ha_nodes[corosync_id] = addrs.get(addr)
 
     corosync_id = get_corosync_id(local_unit())
     if config('prefer-ipv6'):
         addr = get_ipv6_addr()
     else:
-        addr = get_host_ip(unit_get('private-address'))
+        addr = addrs.get(unit_get('private-address'))
 
     ha_nodes[corosync_id] = addr
 
@@ -365,27 +712,74 @@ def get_cluster_nodes():
 
     for relid in relation_ids('hanode'):
         for unit in related_units(relid):
-            if relation_get('ready', rid=relid, unit=unit):
-                hosts.append(relation_get('private-address', unit, relid))
+            settings = relation_settings(relid, unit)
+            if settings.get('ready'):
+                hosts.append(settings.get('private-address'))
 
     hosts.sort()
     return hosts
 
 
+def relation_settings(relid, unit):
+    """Return every relation setting of a unit
+
+    All settings are fetched with a single relation-get call, which is
+    cached for the rest of the hook, so looking up further keys of the same
+    unit does not fork relation-get again.
+
+    @returns dict of relation settings
+    """
+    return relation_get(unit=unit, rid=relid) or {}
+
+
 def parse_data(relid, unit, key):
     """Simple helper to ast parse relation data"""
-    data = relation_get(key, unit, relid)
+    data = relation_settings(relid, unit).get(key)
     if data:
         return ast.literal_eval(data)
 
     return {}
 
 
+def get_relation_snapshot():
+    """Collect the raw ha and hanode relation settings of all related units
+
+    @returns (settings, digest) - settings is a dict keyed by
+             '<relation id> <unit>' and digest is a hash of the settings
+             together with the charm config.
+    """
+    settings = {}
+    for reltype in ['ha', 'hanode']:
+        for relid in relation_ids(reltype):
+            for unit in related_units(relid):
+                settings['%s %s' % (relid, unit)] = \
+                    relation_settings(relid, unit)
+
+    content = json.dumps({'relations': settings, 'config': dict(config())},
+                         sort_keys=True)
+    return settings, hashlib.sha256(content).hexdigest()
+
+
+def relation_snapshot_changed(digest):
+    """Check a snapshot digest against the last one saved
+
+    @returns boolean - True if the relation data or config changed since
+                       save_relation_snapshot() was last called.
+    """
+    saved = kv().get(RELATION_SNAPSHOT_KEY)
+    return not saved or saved.get('digest') != digest
+
+
+def save_relation_snapshot(settings, digest):
+    db = kv()
+    db.set(RELATION_SNAPSHOT_KEY, {'digest': digest, 'settings': settings})
+    db.flush()
+
+
 def configure_stonith():
     if config('stonith_enabled') not in ['true', 'True', True]:
         log('Disabling STONITH', level=INFO)
-        cmd = "crm configure property stonith-enabled=false"
-        pcmk.commit(cmd)
+        pcmk.set_property('stonith-enabled', 'false')
     else:
         log('Enabling STONITH for all nodes in cluster.', level=INFO)
         # configure stontih resources for all nodes in cluster.
@@ -400,14 +794,17 @@ def configure_stonith():
             status_set('blocked', msg)
             raise Exception(msg)
 
-        nodes = maas.MAASHelper(url, creds).list_nodes()
+        cluster_nodes = pcmk.list_nodes()
+        nodes = maas.MAASHelper(url, creds).cached_nodes(
+            cluster_nodes, ttl=config('maas_cache_ttl'))
         if not nodes:
             msg = 'Could not obtain node inventory from ' \
                   'MAAS @ %s.' % url
             status_set('blocked', msg)
             raise Exception(msg)
 
-        cluster_nodes = pcmk.list_nodes()
+        nodes = pcmk.index_maas_nodes(nodes)
+        batch = pcmk.ConfigBatch()
         for node in cluster_nodes:
             rsc, constraint = pcmk.maas_stonith_primitive(nodes, node)
             if not rsc:
@@ -417,18 +814,18 @@ def configure_stonith():
                 raise Exception(msg)
 
             rsc_name = str(rsc).split(' ')[1]
-            if not pcmk.is_resource_present(rsc_name):
+            if not pcmk.crm_opt_exists(rsc_name):
                 log('Creating new STONITH primitive %s.' % rsc_name,
                     level=DEBUG)
-                cmd = 'crm -F configure %s' % rsc
-                pcmk.commit(cmd)
+                batch.add(rsc)
                 if constraint:
-                    cmd = 'crm -F configure %s' % constraint
-                    pcmk.commit(cmd)
+                    batch.add(constraint)
             else:
                 log('STONITH primitive already exists for node.', level=DEBUG)
 
-        pcmk.commit("crm configure property stonith-enabled=true")
+        # All missing primitives and constraints go in as one CIB update
+        batch.commit()
+        pcmk.set_property('stonith-enabled', 'true')
 
 
 def configure_monitor_host():
@@ -448,11 +845,12 @@ def configure_monitor_host():
             cmd = ('crm -w -F configure clone cl_ping ping '
                    'meta interleave="true"')
             pcmk.commit(cmd)
-        else:
+        elif pcmk.get_cib().params('ping').get('host_list') != monitor_host:
             log('Reconfiguring monitor host configuration (host: %s)' %
                 monitor_host, level=DEBUG)
             cmd = ('crm -w -F resource param ping set host_list="%s"' %
                    monitor_host)
+            pcmk.commit(cmd)
     else:
         if pcmk.crm_opt_exists('ping'):
             log('Disabling monitor host configuration', level=DEBUG)
@@ -467,35 +865,157 @@ def configure_cluster_global():
         # NOTE(jamespage) if 3 or more nodes, then quorum can be
         # managed effectively, so stop if quorum lost
         log('Configuring no-quorum-policy to stop', level=DEBUG)
-        cmd = "crm configure property no-quorum-policy=stop"
+        no_quorum_policy = 'stop'
     else:
         # NOTE(jamespage) if less that 3 nodes, quorum not possible
         # so ignore
         log('Configuring no-quorum-policy to ignore', level=DEBUG)
-        cmd = "crm configure property no-quorum-policy=ignore"
+        no_quorum_policy = 'ignore'
+
+    # Only write values which differ from the CIB, every write bumps the
+    # CIB epoch and is replicated to all nodes.
+    pcmk.set_property('no-quorum-policy', no_quorum_policy)
+    pcmk.set_rsc_default('resource-stickiness', '100')
+
+
+def parse_corosync_conf(content):
+    """Split corosync.conf content into its top level sections
+
+    Comments and blank lines are dropped so that only meaningful changes
+    are detected.
+
+    @returns dict of section name -> list of lines within the section
+    """
+    sections = {}
+    current = None
+    depth = 0
+    for line in content.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        if line.endswith('{'):
+            depth += 1
+            if depth == 1:
+                current = line[:-1].strip()
+                sections[current] = []
+                continue
+        elif line == '}':
+            depth -= 1
+            if depth == 0:
+                current = None
+                continue
+
+        if current:
+            sections[current].append(line)
+
+    return sections
+
+
+def _read_file(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return ''
+
+
+def corosync_reconfigure_actions(old_conf, new_conf):
+    """Work out the least disruptive way to apply a corosync.conf change
+
+    Node list and logging changes are picked up by 'corosync-cfgtool -R'
+    and a new expected_votes can be set with corosync-quorumtool; any other
+    change needs corosync to be restarted.
+
+    @param old_conf: previous corosync.conf content
+    @param new_conf: new corosync.conf content
+    @returns list of actions - empty, ['restart'] or a combination of
+             'reload' and 'expected_votes'
+    """
+    old = parse_corosync_conf(old_conf)
+    new = parse_corosync_conf(new_conf)
+    changed = [section for section in set(old) | set(new)
+               if old.get(section) != new.get(section)]
+
+    actions = []
+    for section in changed:
+        if section in COROSYNC_RELOADABLE_SECTIONS:
+            if 'reload' not in actions:
+                actions.append('reload')
+        elif section == 'quorum':
+            # only expected_votes can be changed at runtime
+            strip = [line for line in old.get(section, [])
+                     if not line.startswith('expected_votes:')]
+            if strip == [line for line in new.get(section, [])
+                         if not line.startswith('expected_votes:')]:
+                actions.append('expected_votes')
+            else:
+                return ['restart']
+        else:
+            return ['restart']
+
+    return sorted(actions)
+
+
+def get_expected_votes(conf):
+    for line in parse_corosync_conf(conf).get('quorum', []):
+        if line.startswith('expected_votes:'):
+            return line.split(':', 1)[1].strip()
+
+    return None
+
 
-    pcmk.commit(cmd)
-    cmd = ('crm configure rsc_defaults $id="rsc-options" '
-           'resource-stickiness="100"')
-    pcmk.commit(cmd)
+def apply_corosync_changes(actions, conf):
+    """Apply corosync.conf changes at runtime, restarting if that fails"""
+    if 'restart' in actions or not service_running('corosync'):
+        request_corosync_restart()
+        return
+
+    try:
+        if 'reload' in actions:
+            log('Reloading corosync configuration', level=DEBUG)
+            subprocess.check_call(['corosync-cfgtool', '-R'])
+        if 'expected_votes' in actions:
+            votes = get_expected_votes(conf)
+            if votes:
+                log('Setting corosync expected votes to %s' % votes,
+                    level=DEBUG)
+                subprocess.check_call(['corosync-quorumtool', '-e', votes])
+    except subprocess.CalledProcessError:
+        log('Unable to apply corosync configuration at runtime, '
+            'restarting', level=WARNING)
+        request_corosync_restart()
 
 
 def restart_corosync_on_change():
-    """Simple decorator to restart corosync if any of its config changes"""
+    """Simple decorator to restart corosync if any of its config changes
+
+    Changes to corosync.conf which corosync can apply at runtime are
+    reloaded instead of restarting corosync and pacemaker.
+    """
     def wrap(f):
         def wrapped_f(*args, **kwargs):
             checksums = {}
             for path in COROSYNC_CONF_FILES:
                 checksums[path] = file_hash(path)
+            old_conf = _read_file(COROSYNC_CONF)
             return_data = f(*args, **kwargs)
             # NOTE: this assumes that this call is always done around
             # configure_corosync, which returns true if configuration
             # files where actually generated
             if return_data:
-                for path in COROSYNC_CONF_FILES:
-                    if checksums[path] != file_hash(path):
-                        restart_corosync()
-                        break
+                changed = [path for path in COROSYNC_CONF_FILES
+                           if checksums[path] != file_hash(path)]
+                if changed == [COROSYNC_CONF]:
+                    new_conf = _read_file(COROSYNC_CONF)
+                    actions = corosync_reconfigure_actions(old_conf,
+                                                           new_conf)
+                    log('corosync.conf changed, applying: %s' % actions,
+                        level=DEBUG)
+                    if actions:
+                        apply_corosync_changes(actions, new_conf)
+                elif changed:
+                    request_corosync_restart()
 
             return return_data
         return wrapped_f
@@ -517,6 +1037,194 @@ def restart_corosync():
         service_start("pacemaker")
 
 
+def get_unit_number(unit_name):
+    return int(unit_name.split('/')[1])
+
+
+def corosync_restart_safe(token):
+    """Check whether restarting corosync now keeps the cluster available
+
+    Peers restart one at a time: the leader grants the restart lock to one
+    requesting unit at a time (see grant_corosync_restart). The holder
+    still waits while another node is offline unless the remaining nodes
+    keep quorum.
+
+    @param token: the pending restart request of this unit
+    @returns (safe, reason) - reason explains why it is not safe
+    """
+    if not service_running('corosync'):
+        # not a cluster member yet, starting it disturbs nobody
+        return True, None
+
+    lock = leader_get(RESTART_LOCK_KEY)
+    if lock != '%s:%s' % (local_unit(), token):
+        if lock:
+            return False, ('waiting for %s to restart corosync' %
+                           lock.split(':')[0])
+        return False, 'waiting for the leader to grant the restart'
+
+    try:
+        status = pcmk.ClusterStatus()
+    except subprocess.CalledProcessError:
+        return True, None
+
+    online = [name for name in status.nodes if status.is_online(name)]
+    if (len(online) < len(status.nodes) and
+            not _quorate(len(online) - 1, len(status.nodes))):
+        return False, ('%d of %d nodes online, restarting would lose '
+                       'quorum' % (len(online), len(status.nodes)))
+
+    return True, None
+
+
+def _quorate(online, nodes):
+    """Check whether online of nodes nodes hold a majority"""
+    return online * 2 > nodes
+
+
+def grant_corosync_restart():
+    """Hand the corosync restart lock to the next requesting unit
+
+    Only run on the leader. The lock is released once its holder announced
+    the restart as done (or left the relation) and is then given to the
+    lowest numbered unit with an outstanding request. Leader settings are
+    the only data all units see consistently, so this is what keeps two
+    units from restarting at the same time.
+    """
+    requests = {}
+    token = kv().get(RESTART_PENDING_KEY)
+    if token:
+        requests[local_unit()] = token
+    for relid in relation_ids('hanode'):
+        for unit in related_units(relid):
+            settings = relation_settings(relid, unit)
+            requested = settings.get('corosync-restart-requested')
+            if requested and requested != settings.get(
+                    'corosync-restart-done'):
+                requests[unit] = requested
+
+    lock = leader_get(RESTART_LOCK_KEY)
+    if lock:
+        holder, _, held_token = lock.partition(':')
+        if requests.get(holder) == held_token:
+            return
+
+        log('Corosync restart of %s finished' % holder, level=INFO)
+
+    if requests:
+        unit = min(requests, key=get_unit_number)
+        new_lock = '%s:%s' % (unit, requests[unit])
+        log('Granting corosync restart to %s' % unit, level=INFO)
+    else:
+        new_lock = None
+
+    if new_lock != lock:
+        leader_set({RESTART_LOCK_KEY: new_lock})
+
+
+def request_corosync_restart():
+    """Restart corosync once it is this unit's turn
+
+    The restart is recorded as pending and retried from
+    process_pending_corosync_restart() until corosync_restart_safe()
+    allows it.
+    """
+    db = kv()
+    if not db.get(RESTART_PENDING_KEY):
+        db.set(RESTART_PENDING_KEY, str(uuid.uuid4()))
+        db.flush()
+
+    process_pending_corosync_restart()
+
+
+def corosync_rejoined(timeout=RESTART_REJOIN_TIMEOUT):
+    """Check this node rejoined the cluster after restarting corosync
+
+    The node has to be a pacemaker member and online again in a quorate
+    partition, by the same majority rule corosync_restart_safe applies.
+    Peers which stay offline do not hold up the restart lock.
+
+    @param timeout: seconds to wait for pacemaker to list the node
+    @returns (rejoined, reason) - reason explains what is still missing
+    """
+    if not service_running('pacemaker'):
+        return True, None
+
+    try:
+        pcmk.wait_for_pcmk(timeout=timeout)
+        status = pcmk.ClusterStatus()
+    except Exception as e:
+        return False, str(e)
+
+    hostname = get_hostname()
+    online = [name for name in status.nodes if status.is_online(name)]
+    if hostname not in online:
+        return False, '%s is not online' % hostname
+    if not _quorate(len(online), len(status.nodes)):
+        return False, ('%d of %d nodes online, partition is not '
+                       'quorate' % (len(online), len(status.nodes)))
+
+    return True, None
+
+
+def process_pending_corosync_restart():
+    """Carry out a pending corosync restart if it is safe to do so
+
+    The request is published on the hanode relation for the leader to
+    grant. A completed restart is only announced once this node is a
+    pacemaker member again in a quorate partition, which releases the
+    lock for the next peer. Called from every hook which may unblock it,
+    including update-status, and reported through the workload status
+    while it waits.
+
+    @returns boolean - True if a restart was completed
+    """
+    if is_leader():
+        grant_corosync_restart()
+
+    db = kv()
+    token = db.get(RESTART_PENDING_KEY)
+    if not token:
+        return False
+
+    settings = {'corosync-restart-requested': token}
+    if db.get(RESTART_REJOIN_KEY) != token:
+        for relid in relation_ids('hanode'):
+            relation_set(relation_id=relid, **settings)
+
+        safe, reason = corosync_restart_safe(token)
+        if not safe:
+            log('Deferring corosync restart: %s' % reason, level=INFO)
+            db.set(RESTART_REASON_KEY, reason)
+            db.flush()
+            return False
+
+        restart_corosync()
+        db.set(RESTART_REJOIN_KEY, token)
+        db.flush()
+
+    rejoined, reason = corosync_rejoined()
+    if not rejoined:
+        log('Corosync restarted, waiting to rejoin: %s' % reason,
+            level=WARNING)
+        db.set(RESTART_REASON_KEY, 'restarted, waiting to rejoin: %s' %
+               reason)
+        db.flush()
+        return False
+
+    for key in [RESTART_PENDING_KEY, RESTART_REJOIN_KEY, RESTART_REASON_KEY]:
+        db.unset(key)
+    db.flush()
+    settings['corosync-restart-done'] = token
+    for relid in relation_ids('hanode'):
+        relation_set(relation_id=relid, **settings)
+
+    if is_leader():
+        grant_corosync_restart()
+
+    return True
+
+
 def is_in_standby_mode(node_name):
     """Check if node is in standby mode in pacemaker
 
@@ -558,22 +1266,6 @@ def leave_standby_mode(node_name):
     subprocess.check_call(['crm', 'node', 'online', node_name])
 
 
-def node_has_resources(node_name):
-    """Check if this node is running resources
-
-    @param node_name: The name of the node to check
-    @returns boolean - True if node_name has resources
-    """
-    out = subprocess.check_output(['crm_mon', '-X'])
-    root = ET.fromstring(out)
-    has_resources = False
-    for resource in root.iter('resource'):
-        for child in resource:
-            if child.tag == 'node' and child.attrib.get('name') == node_name:
-                has_resources = True
-    return has_resources
-
-
 def set_unit_status():
     """Set the workload status for this unit
 
@@ -582,38 +1274,115 @@ def set_unit_status():
     status_set(*assess_status_helper())
 
 
-def resume_unit():
+def _poll_cluster_status(check, timeout, interval):
+    """Take one cluster status snapshot per interval until check passes
+
+    @param check: function taking a pcmk.ClusterStatus and the elapsed
+                  seconds, returning whether to stop polling
+    @param timeout: seconds after which to give up
+    @param interval: seconds between two snapshots
+    @returns tuple of whether the check passed and the last snapshot
+    """
+    start = time.time()
+    status = pcmk.ClusterStatus()
+    while True:
+        elapsed = time.time() - start
+        if check(status, elapsed):
+            return True, status
+        if elapsed >= timeout:
+            return False, status
+
+        time.sleep(interval)
+        status.refresh()
+
+
+def resume_unit(timeout=300, interval=5, progress=None):
     """Resume services on this unit and update the units status
 
+    Waits until the node is back online and the resources that left it
+    when it was paused are running here again, or are fully running
+    elsewhere (e.g. held there by their stickiness).
+
+    @param timeout: seconds to wait for the resources to return
+    @param interval: seconds between two cluster status snapshots
+    @param progress: function called with the pending resources and the
+                     elapsed seconds after each snapshot
     @returns None
     """
     node_name = get_hostname()
-    messages = []
+    db = kv()
+    resources = db.get(PAUSED_RESOURCES_KEY) or []
+
+    pending = []
+
+    def check(status, elapsed):
+        pending[:] = [resource for resource in resources
+                      if node_name not in status.locations(resource) and
+                      (status.stopped_instances(resource) or
+                       not status.is_running(resource))]
+        if progress:
+            progress(list(pending), elapsed)
+        return (status.is_online(node_name) and
+                not status.is_standby(node_name) and not pending)
+
     leave_standby_mode(node_name)
-    if is_in_standby_mode(node_name):
+    _, status = _poll_cluster_status(check, timeout, interval)
+    messages = []
+    if status.is_standby(node_name):
         messages.append("Node still in standby mode")
+    elif not status.is_online(node_name):
+        messages.append("Node not online")
+    if pending:
+        messages.append("Resources not running after {}s: {}".format(
+            timeout, ", ".join(pending)))
     if messages:
         raise Exception("Couldn't resume: {}".format("; ".join(messages)))
     else:
+        db.unset(PAUSED_RESOURCES_KEY)
+        db.flush()
         clear_unit_paused()
         set_unit_status()
 
 
-def pause_unit():
+def pause_unit(timeout=300, interval=5, progress=None):
     """Pause services on this unit and update the units status
 
+    Waits until every resource has migrated off the node.
+
+    @param timeout: seconds to wait for the resources to leave the node
+    @param interval: seconds between two cluster status snapshots
+    @param progress: function called with the resources still on the node
+                     and the elapsed seconds after each snapshot
     @returns None
     """
     node_name = get_hostname()
-    messages = []
+
+    pending = []
+
+    def check(status, elapsed):
+        pending[:] = status.resources_on(node_name)
+        if progress:
+            progress(list(pending), elapsed)
+        return status.is_standby(node_name) and not pending
+
+    # keep the resources recorded by an earlier attempt which timed out
+    db = kv()
+    if db.get(PAUSED_RESOURCES_KEY) is None:
+        db.set(PAUSED_RESOURCES_KEY,
+               pcmk.ClusterStatus().resources_on(node_name))
+        db.flush()
+
     enter_standby_mode(node_name)
-    if not is_in_standby_mode(node_name):
+    _, status = _poll_cluster_status(check, timeout, interval)
+    messages = []
+    if not status.is_standby(node_name):
         messages.append("Node not in standby mode")
-    if node_has_resources(node_name):
-        messages.append("Resources still running on unit")
-    status, message = assess_status_helper()
-    if status != 'active':
-        messages.append(message)
+    if pending:
+        messages.append("Resources still running on unit after {}s: "
+                        "{}".format(timeout, ", ".join(pending)))
+    workload_status, workload_message = assess_status_helper()
+    if workload_status != 'active':
+        messages.append(workload_message)
     if messages:
         raise Exception("Couldn't pause: {}".format("; ".join(messages)))
     else:
@@ -622,6 +1391,77 @@ def pause_unit():
                    "Paused. Use 'resume' action to resume normal service.")
 
 
+def _wait_for_resources(resources, moved, timeout, interval):
+    """Poll the cluster until moved(status, resource) holds for all resources
+
+    @returns dict of resource -> seconds it took, None if it timed out
+    """
+    times = dict((resource, None) for resource in resources)
+
+    def check(status, elapsed):
+        for resource in resources:
+            if times[resource] is None and moved(status, resource):
+                times[resource] = elapsed
+        return None not in times.values()
+
+    _poll_cluster_status(check, timeout, interval)
+    return times
+
+
+def benchmark_failover(timeout=300, failback_timeout=120, interval=1):
+    """Measure how long the resources of this node take to fail over
+
+    The node is put into standby and every resource it was running is
+    tracked until it runs on another node and no longer on this one. The
+    node is then brought back online and the time each clone instance
+    takes to start on it again is measured. Other resources stay where
+    they failed over to (the charm sets resource-stickiness=100), so no
+    time is spent waiting for them; they are listed as 'sticky'.
+
+    @param timeout: seconds to wait for the resources to fail over
+    @param failback_timeout: seconds to wait for the clones to come back
+    @param interval: seconds between two cluster status snapshots
+    @returns dict with the 'failover' and 'failback' times, dicts of
+             resource -> seconds or None if it did not move in time, and
+             the 'sticky' resources which are not expected back
+    @raises Exception if the node is in standby or runs no resources
+    """
+    node_name = get_hostname()
+    if is_in_standby_mode(node_name):
+        raise Exception("Node {} is in standby mode".format(node_name))
+
+    status = pcmk.ClusterStatus()
+    resources = status.resources_on(node_name)
+    if not resources:
+        raise Exception("No resources running on {}".format(node_name))
+
+    cloned = [resource for resource in resources
+              if status.is_cloned(resource)]
+
+    def failed_over(status, resource):
+        return (status.is_running(resource) and
+                node_name not in status.locations(resource))
+
+    def failed_back(status, resource):
+        return node_name in status.locations(resource)
+
+    enter_standby_mode(node_name)
+    try:
+        failover = _wait_for_resources(resources, failed_over, timeout,
+                                       interval)
+    finally:
+        leave_standby_mode(node_name)
+
+    failback = {}
+    if cloned:
+        failback = _wait_for_resources(cloned, failed_back,
+                                       failback_timeout, interval)
+
+    return {'failover': failover, 'failback': failback,
+            'sticky': [resource for resource in resources
+                       if resource not in cloned]}
+
+
 def assess_status_helper():
     """Assess status of unit
 
@@ -631,6 +1471,11 @@ def assess_status_helper():
     node_count = int(config('cluster_count'))
     status = 'active'
     message = 'Unit is ready and clustered'
+    db = kv()
+    if db.get(RESTART_PENDING_KEY):
+        return 'waiting', 'Corosync restart pending: {}'.format(
+            db.get(RESTART_REASON_KEY) or 'waiting for its turn')
+
     for relid in relation_ids('hanode'):
         if len(related_units(relid)) + 1 < node_count:
             status = 'blocked'
@@ -0,0 +1,136 @@
+import imp
+import mock
+import os
+import sys
+import unittest
+
+EXPORTER = os.path.join(os.path.dirname(__file__), '..', 'files', 'exporter',
+                        'hacluster-exporter')
+
+# the script has no .py suffix, do not leave bytecode next to it
+sys.dont_write_bytecode, _dont_write_bytecode = True, sys.dont_write_bytecode
+try:
+    exporter = imp.load_source('hacluster_exporter', EXPORTER)
+finally:
+    sys.dont_write_bytecode = _dont_write_bytecode
+
+CRM_MON_XML = '''<crm_mon version="1.1.14">
+  <summary>
+    <current_dc present="true" name="juju-1" with_quorum="true"/>
+  </summary>
+  <nodes>
+    <node name="juju-1" online="true" standby="false"/>
+    <node name="juju-2" online="true" standby="true"/>
+  </nodes>
+  <resources>
+    <resource id="res_vip" role="Started" active="true">
+      <node name="juju-1" id="1000" cached="false"/>
+    </resource>
+  </resources>
+  <node_history>
+    <node name="juju-1">
+      <resource_history id="res_vip" fail-count="2">
+        <operation_history call="12" task="start" exec-time="120ms"
+                           queue-time="0ms"/>
+        <operation_history call="3" task="monitor" exec-time="20ms"
+                           queue-time="0ms"/>
+        <operation_history call="13" task="monitor" interval="10000ms"
+                           exec-time="35ms" queue-time="1ms"/>
+        <operation_history call="14" task="migrate_from" exec-time="80ms"
+                           queue-time="0ms"/>
+      </resource_history>
+    </node>
+  </node_history>
+</crm_mon>
+'''
+
+CIB_XML = '<cib admin_epoch="0" epoch="42" num_updates="7"><status/></cib>'
+
+CMAPCTL = '''nodelist.node.0.nodeid (u32) = 1000
+nodelist.node.0.quorum_votes (u32) = 1
+quorum.expected_votes (u32) = 3
+runtime.totem.pg.mrp.rrp.0.faulty (u8) = 0
+runtime.totem.pg.mrp.rrp.1.faulty (u8) = 1
+runtime.totem.pg.mrp.srp.consensus_timeouts (u64) = 4
+runtime.totem.pg.mrp.srp.members.1000.join_count (u32) = 1
+runtime.totem.pg.mrp.srp.members.1000.status (str) = joined
+runtime.totem.pg.mrp.srp.members.1001.join_count (u32) = 3
+runtime.totem.pg.mrp.srp.members.1001.status (str) = left
+'''
+
+
+class TestExporter(unittest.TestCase):
+
+    def collect(self, outputs):
+        with mock.patch.object(exporter, 'run') as run:
+            run.side_effect = lambda cmd: outputs[cmd[0]]
+            return exporter.collect().splitlines()
+
+    def test_collect(self):
+        metrics = self.collect({'crm_mon': CRM_MON_XML, 'cibadmin': CIB_XML,
+                                'corosync-cmapctl': CMAPCTL})
+        for sample in [
+                'hacluster_pacemaker_up 1.0',
+                'hacluster_quorate 1.0',
+                'hacluster_node_standby{node="juju-2"} 1.0',
+                'hacluster_resource_running{node="juju-1",'
+                'resource="res_vip",role="Started"} 1.0',
+                'hacluster_resource_failcount{node="juju-1",'
+                'resource="res_vip"} 2.0',
+                'hacluster_resource_last_op_duration_seconds{interval="0",'
+                'node="juju-1",operation="start",resource="res_vip"} 0.12',
+                'hacluster_resource_last_op_duration_seconds{interval="0",'
+                'node="juju-1",operation="monitor",resource="res_vip"} 0.02',
+                'hacluster_resource_last_op_duration_seconds{interval="10",'
+                'node="juju-1",operation="monitor",resource="res_vip"} 0.035',
+                'hacluster_resource_last_op_queue_seconds{interval="10",'
+                'node="juju-1",operation="monitor",resource="res_vip"} 0.001',
+                'hacluster_cib_epoch 42.0',
+                'hacluster_corosync_totem_consensus_timeouts_total 4.0',
+                'hacluster_corosync_members 1.0',
+                'hacluster_corosync_member_join_count{nodeid="1001"} 3.0',
+                'hacluster_corosync_ring_faulty{ring="1"} 1.0',
+                'hacluster_corosync_expected_votes 3.0',
+                'hacluster_corosync_node_votes{node="0"} 1.0']:
+            self.assertIn(sample, metrics)
+
+        # no two samples share a series
+        samples = [line.rsplit(' ', 1)[0] for line in metrics
+                   if not line.startswith('#')]
+        self.assertEqual(len(samples), len(set(samples)))
+
+        # every family is declared exactly once, ahead of its samples
+        types = [line.split()[2] for line in metrics
+                 if line.startswith('# TYPE')]
+        self.assertEqual(len(types), len(set(types)))
+        # pacemaker only keeps the last migrate_to/migrate_from, which is
+        # no migration count
+        self.assertNotIn('hacluster_resource_migrations', types)
+        self.assertIn('# TYPE hacluster_corosync_totem_consensus_timeouts_'
+                      'total counter', metrics)
+
+    def test_collect_down(self):
+        metrics = self.collect({'crm_mon': None, 'cibadmin': None,
+                                'corosync-cmapctl': None})
+        self.assertEqual([line for line in metrics
+                          if not line.startswith('#')],
+                         ['hacluster_pacemaker_up 0.0',
+                          'hacluster_corosync_up 0.0'])
+
+    def test_label_escaping(self):
+        metrics = exporter.Metrics()
+        metrics.add('test', 1, {'name': 'a"b\\c\nd'})
+        self.assertIn('test{name="a\\"b\\\\c\\nd"} 1.0',
+                      metrics.render().splitlines())
+
+    @mock.patch.object(exporter, 'collect')
+    @mock.patch.object(exporter.time, 'time')
+    def test_cached_collector(self, time, collect):
+        collect.side_effect = ['first', 'second']
+        collector = exporter.CachedCollector(ttl=10)
+        time.return_value = 100
+        self.assertEqual(collector.get(), 'first')
+        time.return_value = 109
+        self.assertEqual(collector.get(), 'first')
+        time.return_value = 110
+        self.assertEqual(collector.get(), 'second')
@@ -1,12 +1,8 @@
 import mock
 import os
-import sys
 import tempfile
 import unittest
 
-
-mock_apt = mock.MagicMock()
-sys.modules['apt_pkg'] = mock_apt
 import hooks
 
 
@@ -18,6 +14,13 @@ class TestCorosyncConf(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
 
+    @mock.patch.object(hooks, 'save_relation_snapshot')
+    @mock.patch.object(hooks, 'relation_snapshot_changed',
+                       lambda digest: True)
+    @mock.patch.object(hooks, 'get_relation_snapshot',
+                       lambda: ({}, 'digest'))
+    @mock.patch.object(hooks, 'kv')
+    @mock.patch('pcmk.get_cib', lambda: hooks.pcmk.CIB('<cib/>'))
     @mock.patch('pcmk.wait_for_pcmk')
     @mock.patch.object(hooks, 'peer_units')
     @mock.patch('pcmk.crm_opt_exists')
@@ -40,8 +43,9 @@ class TestCorosyncConf(unittest.TestCase):
                                  configure_stonith, configure_monitor_host,
                                  configure_cluster_global, configure_corosync,
                                  oldest_peer, crm_opt_exists, peer_units,
-                                 wait_for_pcmk):
+                                 wait_for_pcmk, kv, save_relation_snapshot):
         crm_opt_exists.return_value = False
+        kv.return_value.get.return_value = {}
         oldest_peer.return_value = True
         related_units.return_value = ['ha/0', 'ha/1', 'ha/2']
         get_cluster_nodes.return_value = ['10.0.3.2', '10.0.3.3', '10.0.3.4']
@@ -70,6 +74,15 @@ class TestCorosyncConf(unittest.TestCase):
 
         parse_data.side_effect = fake_parse_data
 
+        loaded = []
+
+        def fake_commit(cmd, failure_is_fatal=False):
+            if 'configure load update' in cmd:
+                with open(cmd.split()[-1]) as batch:
+                    loaded.extend(batch.read().splitlines())
+
+        commit.side_effect = fake_commit
+
         hooks.ha_relation_changed()
         relation_set.assert_any_call(relation_id='hanode:1', ready=True)
         configure_stonith.assert_called_with()
@@ -77,6 +90,11 @@ class TestCorosyncConf(unittest.TestCase):
         configure_cluster_global.assert_called_with()
         configure_corosync.assert_called_with()
 
+        # all objects are applied through a single CIB update
+        load_calls = [c for c in commit.call_args_list
+                      if 'configure load update' in c[0][0]]
+        self.assertEqual(len(load_calls), 1)
+
         for kw, key in [('location', 'locations'),
                         ('clone', 'clones'),
                         ('group', 'groups'),
@@ -87,9 +105,76 @@ class TestCorosyncConf(unittest.TestCase):
             for name, params in rel_get_data[key].items():
                 if name in rel_get_data['resource_params']:
                     res_params = rel_get_data['resource_params'][name]
-                    commit.assert_any_call(
-                        'crm -w -F configure %s %s %s %s' % (kw, name, params,
-                                                             res_params))
+                    self.assertIn('%s %s %s %s' % (kw, name, params,
+                                                   res_params), loaded)
                 else:
-                    commit.assert_any_call(
-                        'crm -w -F configure %s %s %s' % (kw, name, params))
+                    self.assertIn('%s %s %s' % (kw, name, params), loaded)
+        kv.return_value.set.assert_called_with(hooks.APPLIED_OBJECTS_KEY,
+                                               mock.ANY)
+        save_relation_snapshot.assert_called_with({}, 'digest')
+
+        # a rejected update is neither recorded as applied nor snapshotted
+        kv.reset_mock()
+        save_relation_snapshot.reset_mock()
+        commit.side_effect = hooks.subprocess.CalledProcessError(1, 'crm')
+        self.assertRaises(hooks.subprocess.CalledProcessError,
+                          hooks.ha_relation_changed)
+        self.assertFalse(kv.return_value.set.called)
+        self.assertFalse(save_relation_snapshot.called)
+
+    @mock.patch.object(hooks, 'get_corosync_conf')
+    @mock.patch.object(hooks, 'relation_snapshot_changed')
+    @mock.patch.object(hooks, 'get_relation_snapshot')
+    def test_ha_relation_changed_unchanged(self, get_relation_snapshot,
+                                           relation_snapshot_changed,
+                                           get_corosync_conf):
+        get_relation_snapshot.return_value = ({}, 'digest')
+        relation_snapshot_changed.return_value = False
+        hooks.ha_relation_changed()
+        relation_snapshot_changed.assert_called_with('digest')
+        self.assertFalse(get_corosync_conf.called)
+
+    @mock.patch.object(hooks, 'apt_purge')
+    @mock.patch.object(hooks, 'remove_metrics_exporter')
+    @mock.patch('pcmk.commit')
+    @mock.patch('socket.gethostname', lambda: 'juju-machine-1')
+    def test_stop(self, commit, remove_metrics_exporter, apt_purge):
+        cron = os.path.join(self.tmpdir, 'hacluster-status-collector')
+        with open(cron, 'w') as f:
+            f.write('* * * * * root collect_cluster_status\n')
+
+        with mock.patch.object(hooks, 'STATUS_COLLECTOR_CRON', cron):
+            hooks.stop()
+
+        commit.assert_called_once_with(
+            'crm -w -F node delete juju-machine-1')
+        remove_metrics_exporter.assert_called_once_with()
+        self.assertFalse(os.path.exists(cron))
+        apt_purge.assert_called_once_with(['corosync', 'pacemaker'],
+                                          fatal=True)
+
+    @mock.patch.object(hooks.subprocess, 'call')
+    @mock.patch.object(hooks, 'relation_ids')
+    def test_configure_status_collector(self, relation_ids, call):
+        cron = os.path.join(self.tmpdir, 'hacluster-status-collector')
+        collector = os.path.join(hooks.NAGIOS_PLUGINS_DIR,
+                                 'collect_cluster_status')
+        with mock.patch.object(hooks, 'STATUS_COLLECTOR_CRON', cron), \
+                mock.patch.object(hooks, 'write_file') as write_file:
+            # nothing is sampled on units without an NRPE relation
+            relation_ids.return_value = []
+            hooks.configure_status_collector()
+            self.assertFalse(write_file.called)
+            self.assertFalse(call.called)
+
+            relation_ids.return_value = ['nrpe-external-master:2']
+            hooks.configure_status_collector()
+            write_file.assert_called_once_with(
+                cron, '* * * * * root %s\n' % collector, perms=0o644)
+            call.assert_called_once_with([collector])
+
+            with open(cron, 'w') as f:
+                f.write('* * * * * root %s\n' % collector)
+            relation_ids.return_value = []
+            hooks.configure_status_collector()
+            self.assertFalse(os.path.exists(cron))
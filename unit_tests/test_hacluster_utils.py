@@ -7,6 +7,8 @@ import unittest
 
 import utils
 
+from charmhelpers.core import hookenv
+
 
 def write_file(path, content, *args, **kwargs):
     with open(path, 'w') as f:
@@ -21,6 +23,7 @@ class UtilsTestCase(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
         utils.COROSYNC_CONF = os.path.join(self.tmpdir, 'corosync.conf')
+        hookenv.cache.clear()
 
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
@@ -46,7 +49,8 @@ class UtilsTestCase(unittest.TestCase):
         get_network_address.return_value = "127.0.0.1"
         relation_ids.return_value = ['foo:1']
         related_units.return_value = ['unit-machine-0']
-        relation_get.return_value = 'iface'
+        relation_get.return_value = {'corosync_bindiface': 'iface',
+                                     'corosync_mcastport': '1234'}
 
         conf = utils.get_corosync_conf()
 
@@ -90,16 +94,17 @@ class UtilsTestCase(unittest.TestCase):
 
     @mock.patch.object(utils, 'local_unit', lambda *args: 'hanode/0')
     @mock.patch.object(utils, 'get_ipv6_addr')
-    @mock.patch.object(utils, 'get_host_ip')
+    @mock.patch.object(utils.resolver, 'resolve_hosts')
     @mock.patch.object(utils.utils, 'is_ipv6', lambda *args: None)
     @mock.patch.object(utils, 'get_corosync_id', lambda u: "%s-cid" % (u))
     @mock.patch.object(utils, 'peer_ips', lambda *args, **kwargs:
                        {'hanode/1': '10.0.0.2'})
     @mock.patch.object(utils, 'unit_get')
     @mock.patch.object(utils, 'config')
-    def test_get_ha_nodes(self, mock_config, mock_unit_get, mock_get_host_ip,
-                          mock_get_ipv6_addr):
-        mock_get_host_ip.side_effect = lambda host: host
+    def test_get_ha_nodes(self, mock_config, mock_unit_get,
+                          mock_resolve_hosts, mock_get_ipv6_addr):
+        mock_resolve_hosts.side_effect = lambda hosts: dict(
+            (host, host) for host in hosts)
 
         def unit_get(key):
             return {'private-address': '10.0.0.1'}.get(key)
@@ -114,12 +119,12 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEqual(nodes, {'hanode/0-cid': '10.0.0.1',
                                  'hanode/1-cid': '10.0.0.2'})
 
-        self.assertTrue(mock_get_host_ip.called)
+        mock_resolve_hosts.assert_called_once_with(['10.0.0.2', '10.0.0.1'])
         self.assertFalse(mock_get_ipv6_addr.called)
 
     @mock.patch.object(utils, 'local_unit', lambda *args: 'hanode/0')
     @mock.patch.object(utils, 'get_ipv6_addr')
-    @mock.patch.object(utils, 'get_host_ip')
+    @mock.patch.object(utils.resolver, 'resolve_hosts')
     @mock.patch.object(utils.utils, 'is_ipv6')
     @mock.patch.object(utils, 'get_corosync_id', lambda u: "%s-cid" % (u))
     @mock.patch.object(utils, 'peer_ips', lambda *args, **kwargs:
@@ -127,9 +132,8 @@ class UtilsTestCase(unittest.TestCase):
     @mock.patch.object(utils, 'unit_get')
     @mock.patch.object(utils, 'config')
     def test_get_ha_nodes_ipv6(self, mock_config, mock_unit_get, mock_is_ipv6,
-                               mock_get_host_ip, mock_get_ipv6_addr):
+                               mock_resolve_hosts, mock_get_ipv6_addr):
         mock_get_ipv6_addr.return_value = '2001:db8:1::1'
-        mock_get_host_ip.side_effect = lambda host: host
 
         def unit_get(key):
             return {'private-address': '10.0.0.1'}.get(key)
@@ -144,5 +148,771 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEqual(nodes, {'hanode/0-cid': '2001:db8:1::1',
                                  'hanode/1-cid': '2001:db8:1::2'})
 
-        self.assertFalse(mock_get_host_ip.called)
+        self.assertFalse(mock_resolve_hosts.called)
         self.assertTrue(mock_get_ipv6_addr.called)
+
+    @mock.patch.object(utils, 'kv')
+    @mock.patch.object(utils, 'config')
+    @mock.patch.object(utils, 'relation_get')
+    @mock.patch.object(utils, 'related_units')
+    @mock.patch.object(utils, 'relation_ids')
+    def test_relation_snapshot(self, relation_ids, related_units,
+                               relation_get, mock_config, kv):
+        relation_ids.side_effect = lambda reltype: ['%s:1' % reltype]
+        related_units.side_effect = lambda relid: ['%s/0' % relid[:-2]]
+        relation_get.side_effect = lambda unit, rid: {'unit': unit}
+        mock_config.return_value = {'cluster_count': 3}
+        store = {}
+        kv.return_value.get.side_effect = store.get
+        kv.return_value.set.side_effect = store.__setitem__
+
+        settings, digest = utils.get_relation_snapshot()
+        self.assertEqual(settings, {'ha:1 ha/0': {'unit': 'ha/0'},
+                                    'hanode:1 hanode/0': {'unit':
+                                                          'hanode/0'}})
+        self.assertTrue(utils.relation_snapshot_changed(digest))
+        utils.save_relation_snapshot(settings, digest)
+        self.assertFalse(utils.relation_snapshot_changed(digest))
+
+        mock_config.return_value = {'cluster_count': 4}
+        self.assertNotEqual(utils.get_relation_snapshot()[1], digest)
+
+    @mock.patch.object(utils, 'relation_get')
+    @mock.patch.object(utils, 'related_units')
+    @mock.patch.object(utils, 'relation_ids')
+    @mock.patch.object(utils, 'unit_get')
+    @mock.patch.object(utils, 'config')
+    def test_get_cluster_nodes(self, mock_config, unit_get, relation_ids,
+                               related_units, relation_get):
+        mock_config.return_value = False
+        unit_get.return_value = '10.0.0.1'
+        relation_ids.return_value = ['hanode:1']
+        related_units.return_value = ['hanode/1', 'hanode/2']
+        settings = {'hanode/1': {'private-address': '10.0.0.3',
+                                 'ready': 'True'},
+                    'hanode/2': {'private-address': '10.0.0.2'}}
+        relation_get.side_effect = lambda unit, rid: settings[unit]
+        self.assertEqual(utils.get_cluster_nodes(), ['10.0.0.1', '10.0.0.3'])
+        # one relation-get per unit, covering every key needed
+        relation_get.assert_has_calls([mock.call(unit='hanode/1',
+                                                 rid='hanode:1'),
+                                       mock.call(unit='hanode/2',
+                                                 rid='hanode:1')])
+        self.assertEqual(relation_get.call_count, 2)
+
+    @mock.patch.object(utils, 'relation_get')
+    def test_parse_data(self, relation_get):
+        relation_get.return_value = {'resources': "{'res_foo': 'ocf:foo'}"}
+        self.assertEqual(utils.parse_data('ha:1', 'ha/0', 'resources'),
+                         {'res_foo': 'ocf:foo'})
+        self.assertEqual(utils.parse_data('ha:1', 'ha/0', 'groups'), {})
+        relation_get.assert_called_with(unit='ha/0', rid='ha:1')
+
+    @mock.patch('pcmk.commit')
+    @mock.patch('pcmk.get_cib')
+    @mock.patch.object(utils, 'config')
+    def test_configure_cluster_global(self, mock_config, get_cib, commit):
+        mock_config.return_value = 3
+        get_cib.return_value = utils.pcmk.CIB(
+            '<cib><configuration><crm_config><cluster_property_set>'
+            '<nvpair name="no-quorum-policy" value="ignore"/>'
+            '</cluster_property_set></crm_config><rsc_defaults>'
+            '<meta_attributes><nvpair name="resource-stickiness" '
+            'value="100"/></meta_attributes></rsc_defaults>'
+            '</configuration></cib>')
+        utils.configure_cluster_global()
+        commit.assert_called_once_with(
+            'crm configure property no-quorum-policy=stop')
+
+        commit.reset_mock()
+        mock_config.return_value = 2
+        utils.configure_cluster_global()
+        self.assertFalse(commit.called)
+
+    @mock.patch('pcmk.commit')
+    @mock.patch('pcmk.get_cib')
+    @mock.patch.object(utils, 'config')
+    def test_configure_monitor_host(self, mock_config, get_cib, commit):
+        cfg = {'monitor_host': '10.0.0.1'}
+        mock_config.side_effect = cfg.get
+        get_cib.return_value = utils.pcmk.CIB(
+            '<cib><configuration><resources><clone id="cl_ping">'
+            '<primitive id="ping"><instance_attributes>'
+            '<nvpair name="host_list" value="10.0.0.1"/>'
+            '</instance_attributes></primitive></clone></resources>'
+            '</configuration></cib>')
+        utils.configure_monitor_host()
+        self.assertFalse(commit.called)
+
+        cfg['monitor_host'] = '10.0.0.2'
+        utils.configure_monitor_host()
+        commit.assert_called_once_with(
+            'crm -w -F resource param ping set host_list="10.0.0.2"')
+
+    @mock.patch('pcmk.ConfigBatch')
+    @mock.patch('pcmk.set_property')
+    @mock.patch('pcmk.crm_opt_exists')
+    @mock.patch('pcmk.list_nodes')
+    @mock.patch('maas.MAASHelper')
+    @mock.patch.object(utils, 'config')
+    def test_configure_stonith(self, mock_config, MAASHelper, list_nodes,
+                               crm_opt_exists, set_property, ConfigBatch):
+        cfg = {'stonith_enabled': 'True',
+               'maas_url': 'http://maas/MAAS/api/1.0',
+               'maas_credentials': 'a:b:c',
+               'maas_cache_ttl': 3600}
+        mock_config.side_effect = cfg.get
+        power_params = {'power_address': '10.0.1.1', 'power_user': 'admin',
+                        'power_pass': 'secret'}
+        MAASHelper.return_value.cached_nodes.return_value = [
+            {'hostname': 'node%d.maas' % i, 'power_type': 'ipmi',
+             'power_parameters': power_params} for i in range(1, 11)]
+        list_nodes.return_value = ['node1', 'node10']
+        crm_opt_exists.side_effect = lambda rsc: rsc == 'res_stonith_node1'
+
+        utils.configure_stonith()
+        batch = ConfigBatch.return_value
+        batch.add.assert_has_calls([
+            mock.call(mock.ANY),
+            mock.call('location const_loc_stonith_avoid_node10 '
+                      'res_stonith_node10 -inf: node10')])
+        self.assertEqual(batch.add.call_count, 2)
+        self.assertTrue(batch.add.call_args_list[0][0][0].startswith(
+            'primitive res_stonith_node10 stonith:external/ipmi '
+            'params hostname=node10 '))
+        batch.commit.assert_called_once_with()
+        set_property.assert_called_with('stonith-enabled', 'true')
+        MAASHelper.return_value.cached_nodes.assert_called_with(
+            ['node1', 'node10'], ttl=3600)
+
+    def render_corosync_conf(self, **kwargs):
+        ctxt = {'corosync_bindnetaddr': '10.0.0.0',
+                'corosync_mcastaddr': '226.94.1.1',
+                'corosync_mcastport': 5405,
+                'ip_version': 'ipv4',
+                'transport': 'udpu',
+                'totem': utils.COROSYNC_PROFILES['default'],
+                'crypto': {'cipher': 'none', 'hash': 'none', 'threads': 0},
+                'ha_nodes': {1000: '10.0.0.1', 1001: '10.0.0.2',
+                             1002: '10.0.0.3'}}
+        ctxt.update(kwargs)
+        return utils.render_template('corosync.conf', ctxt)
+
+    def test_corosync_reconfigure_actions(self):
+        conf = self.render_corosync_conf()
+        self.assertEqual(utils.corosync_reconfigure_actions(conf, conf), [])
+
+        # scaling out on udpu only changes the node list
+        nodes = {1000: '10.0.0.1', 1001: '10.0.0.2', 1002: '10.0.0.3',
+                 1003: '10.0.0.4'}
+        self.assertEqual(utils.corosync_reconfigure_actions(
+            conf, self.render_corosync_conf(ha_nodes=nodes)), ['reload'])
+        self.assertEqual(utils.corosync_reconfigure_actions(
+            conf, self.render_corosync_conf(debug=True)), ['reload'])
+
+        # on udp the votes follow the number of nodes
+        udp = self.render_corosync_conf(transport='udp')
+        self.assertEqual(utils.corosync_reconfigure_actions(
+            udp, self.render_corosync_conf(transport='udp', ha_nodes=nodes)),
+            ['expected_votes'])
+        self.assertEqual(utils.get_expected_votes(udp), '3')
+
+        # totem changes and leaving two_node mode need a restart
+        self.assertEqual(utils.corosync_reconfigure_actions(
+            conf, self.render_corosync_conf(netmtu=9000)), ['restart'])
+        self.assertEqual(utils.corosync_reconfigure_actions(
+            conf, self.render_corosync_conf(
+                totem=utils.COROSYNC_PROFILES['wan'])), ['restart'])
+        two_nodes = {1000: '10.0.0.1', 1001: '10.0.0.2'}
+        self.assertEqual(utils.corosync_reconfigure_actions(
+            self.render_corosync_conf(ha_nodes=two_nodes), conf),
+            ['restart'])
+        self.assertEqual(utils.corosync_reconfigure_actions('', conf),
+                         ['restart'])
+
+    @mock.patch.object(utils, 'request_corosync_restart')
+    @mock.patch.object(utils, 'service_running')
+    @mock.patch('subprocess.check_call')
+    def test_apply_corosync_changes(self, check_call, service_running,
+                                    request_corosync_restart):
+        service_running.return_value = True
+        conf = self.render_corosync_conf(transport='udp')
+        utils.apply_corosync_changes(['expected_votes', 'reload'], conf)
+        check_call.assert_has_calls([
+            mock.call(['corosync-cfgtool', '-R']),
+            mock.call(['corosync-quorumtool', '-e', '3'])])
+        self.assertFalse(request_corosync_restart.called)
+
+        check_call.side_effect = utils.subprocess.CalledProcessError(1, '')
+        utils.apply_corosync_changes(['reload'], conf)
+        request_corosync_restart.assert_called_once_with()
+
+    @mock.patch.object(utils, 'local_unit', lambda: 'hacluster/1')
+    @mock.patch('pcmk.ClusterStatus')
+    @mock.patch.object(utils, 'leader_get')
+    @mock.patch.object(utils, 'service_running')
+    def test_corosync_restart_safe(self, service_running, leader_get,
+                                   ClusterStatus):
+        service_running.return_value = True
+        leader_get.return_value = None
+        status = ClusterStatus.return_value
+        status.nodes = dict(('node%d' % i, {'online': 'true'})
+                            for i in range(3))
+        status.is_online.side_effect = (
+            lambda name: status.nodes[name]['online'] == 'true')
+
+        # nobody restarts without the lock from the leader
+        self.assertEqual(utils.corosync_restart_safe('x'),
+                         (False, 'waiting for the leader to grant the '
+                          'restart'))
+        leader_get.return_value = 'hacluster/0:y'
+        self.assertEqual(utils.corosync_restart_safe('x'),
+                         (False, 'waiting for hacluster/0 to restart '
+                          'corosync'))
+        leader_get.assert_called_with(utils.RESTART_LOCK_KEY)
+
+        leader_get.return_value = 'hacluster/1:x'
+        self.assertEqual(utils.corosync_restart_safe('x'), (True, None))
+
+        # a peer which is down (e.g. restarting) blocks a 3 node cluster
+        status.nodes['node0']['online'] = 'false'
+        self.assertFalse(utils.corosync_restart_safe('x')[0])
+
+        # starting corosync on a unit which is not a member yet is harmless
+        leader_get.return_value = None
+        service_running.return_value = False
+        self.assertEqual(utils.corosync_restart_safe('x'), (True, None))
+
+    @mock.patch.object(utils, 'get_hostname', lambda: 'node0')
+    @mock.patch('pcmk.ClusterStatus')
+    @mock.patch('pcmk.wait_for_pcmk')
+    @mock.patch.object(utils, 'service_running', lambda svc: True)
+    def test_corosync_rejoined(self, wait_for_pcmk, ClusterStatus):
+        status = ClusterStatus.return_value
+        status.nodes = dict(('node%d' % i, {'online': 'true'})
+                            for i in range(5))
+        status.is_online.side_effect = (
+            lambda name: status.nodes[name]['online'] == 'true')
+
+        # a peer which stays offline does not hold up the restart lock
+        status.nodes['node4']['online'] = 'false'
+        self.assertEqual(utils.corosync_rejoined(), (True, None))
+        wait_for_pcmk.assert_called_with(
+            timeout=utils.RESTART_REJOIN_TIMEOUT)
+        # the same peer does not stop the next unit from restarting either
+        with mock.patch.object(utils, 'leader_get', lambda key: 'u/1:x'), \
+                mock.patch.object(utils, 'local_unit', lambda: 'u/1'):
+            self.assertEqual(utils.corosync_restart_safe('x'), (True, None))
+
+        status.nodes['node0']['online'] = 'false'
+        self.assertEqual(utils.corosync_rejoined(),
+                         (False, 'node0 is not online'))
+
+        status.nodes['node0']['online'] = 'true'
+        status.nodes['node3']['online'] = 'false'
+        status.nodes['node2']['online'] = 'false'
+        self.assertFalse(utils.corosync_rejoined()[0])
+
+        wait_for_pcmk.side_effect = Exception('not a member')
+        self.assertEqual(utils.corosync_rejoined(), (False, 'not a member'))
+
+    @mock.patch.object(utils, 'local_unit', lambda: 'hacluster/1')
+    @mock.patch.object(utils, 'leader_set')
+    @mock.patch.object(utils, 'leader_get')
+    @mock.patch.object(utils, 'relation_get')
+    @mock.patch.object(utils, 'related_units')
+    @mock.patch.object(utils, 'relation_ids', lambda r: ['hanode:1'])
+    @mock.patch.object(utils, 'kv')
+    def test_grant_corosync_restart(self, kv, related_units, relation_get,
+                                    leader_get, leader_set):
+        kv.return_value.get.return_value = 'local'
+        related_units.return_value = ['hacluster/0', 'hacluster/2']
+        settings = {'hacluster/0': {}, 'hacluster/2': {}}
+        relation_get.side_effect = lambda unit, rid: settings[unit]
+        leader_get.return_value = None
+
+        # the lowest numbered requester gets the lock
+        settings['hacluster/2'] = {'corosync-restart-requested': 'c'}
+        utils.grant_corosync_restart()
+        leader_set.assert_called_once_with(
+            {utils.RESTART_LOCK_KEY: 'hacluster/1:local'})
+
+        # the lock stays with its holder until it is done
+        leader_set.reset_mock()
+        settings['hacluster/0'] = {'corosync-restart-requested': 'a'}
+        leader_get.return_value = 'hacluster/2:c'
+        utils.grant_corosync_restart()
+        self.assertFalse(leader_set.called)
+
+        settings['hacluster/2']['corosync-restart-done'] = 'c'
+        utils.grant_corosync_restart()
+        leader_set.assert_called_once_with(
+            {utils.RESTART_LOCK_KEY: 'hacluster/0:a'})
+
+        # released once nobody asks for it any more
+        leader_set.reset_mock()
+        kv.return_value.get.return_value = None
+        settings['hacluster/0']['corosync-restart-done'] = 'a'
+        leader_get.return_value = 'hacluster/0:a'
+        utils.grant_corosync_restart()
+        leader_set.assert_called_once_with({utils.RESTART_LOCK_KEY: None})
+
+    @mock.patch.object(utils, 'is_leader', lambda: False)
+    @mock.patch.object(utils, 'corosync_rejoined')
+    @mock.patch.object(utils, 'relation_set')
+    @mock.patch.object(utils, 'relation_ids', lambda r: ['hanode:1'])
+    @mock.patch.object(utils, 'restart_corosync')
+    @mock.patch.object(utils, 'corosync_restart_safe')
+    @mock.patch.object(utils, 'kv')
+    def test_request_corosync_restart(self, kv, corosync_restart_safe,
+                                      restart_corosync, relation_set,
+                                      corosync_rejoined):
+        store = {}
+        kv.return_value.get.side_effect = store.get
+        kv.return_value.set.side_effect = store.__setitem__
+        kv.return_value.unset.side_effect = store.pop
+        corosync_restart_safe.return_value = (False, 'peer restarting')
+
+        utils.request_corosync_restart()
+        token = store[utils.RESTART_PENDING_KEY]
+        self.assertFalse(restart_corosync.called)
+        relation_set.assert_called_with(
+            relation_id='hanode:1', **{'corosync-restart-requested': token})
+        with mock.patch.object(utils, 'config', lambda k: 2):
+            self.assertEqual(utils.assess_status_helper(),
+                             ('waiting', 'Corosync restart pending: peer '
+                              'restarting'))
+
+        # the node has not rejoined yet, do not release the lock
+        corosync_restart_safe.return_value = (True, None)
+        corosync_rejoined.return_value = (False, 'node2 offline')
+        self.assertFalse(utils.process_pending_corosync_restart())
+        restart_corosync.assert_called_once_with()
+        self.assertEqual(store[utils.RESTART_REJOIN_KEY], token)
+
+        # corosync is not restarted a second time once it rejoined
+        corosync_rejoined.return_value = (True, None)
+        self.assertTrue(utils.process_pending_corosync_restart())
+        restart_corosync.assert_called_once_with()
+        relation_set.assert_called_with(
+            relation_id='hanode:1',
+            **{'corosync-restart-requested': token,
+               'corosync-restart-done': token})
+        self.assertEqual(store, {})
+        self.assertFalse(utils.process_pending_corosync_restart())
+
+    @mock.patch.object(utils, 'config')
+    def test_get_totem_settings(self, mock_config):
+        cfg = {}
+        mock_config.side_effect = cfg.get
+        self.assertEqual(utils.get_totem_settings(),
+                         {'token': 3000, 'consensus': 3600, 'join': 60,
+                          'max_messages': 20, 'window_size': None,
+                          'send_join': None})
+
+        # overriding only the token derives consensus from it
+        cfg['corosync_token'] = 5000
+        totem = utils.get_totem_settings()
+        self.assertEqual((totem['token'], totem['consensus']), (5000, 6000))
+
+        cfg.update({'corosync_profile': 'lan-fast', 'corosync_token': 800,
+                    'corosync_window_size': 30})
+        totem = utils.get_totem_settings()
+        self.assertEqual((totem['token'], totem['consensus'],
+                          totem['window_size']), (800, 960, 30))
+
+        cfg['corosync_consensus'] = 900
+        self.assertRaises(ValueError, utils.get_totem_settings)
+        cfg['corosync_consensus'] = 960
+        cfg['corosync_max_messages'] = 40
+        self.assertRaises(ValueError, utils.get_totem_settings)
+        cfg['corosync_max_messages'] = 30
+        self.assertEqual(utils.get_totem_settings()['consensus'], 960)
+
+        cfg['corosync_profile'] = 'lan-slow'
+        self.assertRaises(ValueError, utils.get_totem_settings)
+
+    def test_render_totem_settings(self):
+        conf = utils.parse_corosync_conf(self.render_corosync_conf(
+            totem=utils.COROSYNC_PROFILES['wan']))
+        for line in ['token: 10000', 'consensus: 12000', 'join: 1000',
+                     'max_messages: 17', 'window_size: 50',
+                     'send_join: 80']:
+            self.assertIn(line, conf['totem'])
+
+        conf = utils.parse_corosync_conf(self.render_corosync_conf())
+        self.assertFalse([line for line in conf['totem']
+                          if line.startswith(('window_size', 'send_join'))])
+
+    @mock.patch.object(utils, 'netifaces')
+    def test_get_iface_addresses(self, netifaces):
+        netifaces.AF_INET, netifaces.AF_INET6 = 2, 10
+        netifaces.interfaces.return_value = ['lo', 'eth0', 'eth1']
+        netifaces.ifaddresses.side_effect = {
+            'lo': {2: [{'addr': '127.0.0.1', 'netmask': '255.0.0.0'}]},
+            'eth0': {2: [{'addr': '10.5.0.10', 'netmask': '255.255.0.0'}],
+                     10: [{'addr': '2001:db8::10',
+                           'netmask': 'ffff:ffff:ffff:ffff::/64'},
+                          {'addr': 'fe80::1%eth0',
+                           'netmask': 'ffff:ffff:ffff:ffff::'}]},
+            'eth1': {17: [{'addr': '52:54:00:00:00:01'}]},
+        }.get
+
+        self.assertEqual(utils.get_iface_ipaddr('eth0'), '10.5.0.10')
+        self.assertEqual(utils.get_iface_netmask('eth0'), '255.255.0.0')
+        self.assertEqual(utils.get_network_address('eth0'), '10.5.0.0')
+        self.assertEqual(utils.get_iface_addresses()['eth0']['ipv6'],
+                         [{'addr': '2001:db8::10',
+                           'netmask': 'ffff:ffff:ffff:ffff::'},
+                          {'addr': 'fe80::1',
+                           'netmask': 'ffff:ffff:ffff:ffff::'}])
+        self.assertRaises(IOError, utils.get_iface_ipaddr, 'eth1')
+        self.assertRaises(IOError, utils.get_iface_ipaddr, 'eth2')
+        # every interface is only read once per hook
+        self.assertEqual(netifaces.ifaddresses.call_count, 3)
+
+        with mock.patch.object(utils.utils, 'get_ipv6_addr') as get_ipv6:
+            get_ipv6.return_value = ['2001:db8::10']
+            self.assertEqual(utils.get_ipv6_network_address('eth0'),
+                             '2001:db8::')
+
+    @mock.patch.object(utils, 'get_iface_addresses')
+    @mock.patch.object(utils, 'parse_data')
+    @mock.patch.object(utils, 'related_units', lambda rid: ['ha/0'])
+    @mock.patch.object(utils, 'relation_ids', lambda rel: ['ha:1'])
+    def test_get_ipv6_addr_excludes(self, parse_data, get_iface_addresses):
+        get_iface_addresses.return_value = {
+            'eth0': {'ipv4': [], 'ipv6': [{'addr': '2001:db8::10',
+                                           'netmask': 'ffff:ffff::'}]}}
+        data = {
+            'resources': {'res_vip': 'ocf:heartbeat:IPv6addr'},
+            'resource_params': {'ocf:heartbeat:IPv6addr': {
+                'local': ('ipv6addr', '2001:DB8::0100'),
+                'remote': ('ipv6addr', '2001:db9::100')}},
+        }
+        parse_data.side_effect = lambda rid, unit, key: data[key]
+
+        with mock.patch.object(utils.utils, 'get_ipv6_addr') as get_ipv6:
+            get_ipv6.return_value = ['2001:db8::10']
+            self.assertEqual(utils.get_ipv6_addr(), '2001:db8::10')
+            get_ipv6.assert_called_once_with(exc_list={'2001:db8::100'})
+
+    @mock.patch.object(utils, 'service_restart')
+    @mock.patch.object(utils, 'service_start')
+    @mock.patch.object(utils, 'service_running')
+    @mock.patch.object(utils.subprocess, 'check_call')
+    @mock.patch.object(utils, 'init_is_systemd', lambda: True)
+    @mock.patch.object(utils.shutil, 'copy2')
+    @mock.patch.object(utils, 'file_hash')
+    @mock.patch.object(utils, 'config')
+    def test_configure_metrics_exporter(self, mock_config, file_hash, copy2,
+                                        check_call, service_running,
+                                        service_start, service_restart):
+        cfg = {'metrics_port': 9664, 'metrics_address': '10.0.0.10'}
+        mock_config.side_effect = lambda key: cfg[key]
+        file_hash.side_effect = ['a', 'b', 'a', 'c']
+        service_running.return_value = True
+        with mock.patch.object(utils, 'write_file') as write_file:
+            self.assertEqual(utils.configure_metrics_exporter(), 9664)
+
+        write_file.assert_called_once_with(
+            '/etc/systemd/system/hacluster-exporter.service', mock.ANY,
+            perms=0o644)
+        self.assertIn('ExecStart=/usr/local/bin/hacluster-exporter --address '
+                      '10.0.0.10 --port 9664', write_file.call_args[0][1])
+        check_call.assert_called_with(['systemctl', 'enable',
+                                       'hacluster-exporter'])
+        service_restart.assert_called_once_with('hacluster-exporter')
+        self.assertFalse(service_start.called)
+
+        cfg['metrics_port'] = 0
+        with mock.patch.object(utils.os.path, 'exists', lambda path: False):
+            self.assertEqual(utils.configure_metrics_exporter(), None)
+
+    @mock.patch.object(utils.os, 'remove')
+    @mock.patch.object(utils.os.path, 'exists', lambda path: True)
+    @mock.patch.object(utils, 'service_stop')
+    @mock.patch.object(utils.subprocess, 'check_call')
+    @mock.patch.object(utils, 'init_is_systemd', lambda: True)
+    def test_remove_metrics_exporter(self, check_call, service_stop, remove):
+        utils.remove_metrics_exporter()
+        service_stop.assert_called_once_with('hacluster-exporter')
+        check_call.assert_has_calls([
+            mock.call(['systemctl', 'disable', 'hacluster-exporter']),
+            mock.call(['systemctl', 'daemon-reload'])])
+        remove.assert_has_calls([
+            mock.call('/etc/systemd/system/hacluster-exporter.service'),
+            mock.call('/usr/local/bin/hacluster-exporter')])
+
+    @mock.patch.object(utils.time, 'sleep')
+    @mock.patch.object(utils.time, 'time')
+    @mock.patch.object(utils, 'leave_standby_mode')
+    @mock.patch.object(utils, 'enter_standby_mode')
+    @mock.patch.object(utils, 'is_in_standby_mode', lambda node: False)
+    @mock.patch.object(utils, 'get_hostname', lambda: 'node1')
+    @mock.patch.object(utils.pcmk, 'ClusterStatus')
+    def test_benchmark_failover(self, ClusterStatus, enter_standby_mode,
+                                leave_standby_mode, mock_time, sleep):
+        # resource -> nodes running it, one snapshot per poll
+        snapshots = [
+            {'res_vip': ['node1'], 'res_haproxy': ['node1', 'node2']},
+            {'res_vip': ['node1'], 'res_haproxy': ['node1', 'node2']},
+            {'res_vip': [], 'res_haproxy': ['node2']},
+            {'res_vip': ['node2'], 'res_haproxy': ['node2']},
+            {'res_vip': ['node2'], 'res_haproxy': ['node2']},
+            {'res_vip': ['node2'], 'res_haproxy': ['node1', 'node2']},
+            {'res_vip': ['node2'], 'res_haproxy': ['node1', 'node2']},
+        ]
+        clock = [0]
+
+        class FakeStatus(object):
+            def __init__(self):
+                self.current = snapshots.pop(0)
+
+            def refresh(self):
+                self.current = snapshots.pop(0)
+
+            def resources_on(self, node):
+                return sorted(r for r, nodes in self.current.items()
+                              if node in nodes)
+
+            def is_running(self, resource):
+                return bool(self.current[resource])
+
+            def locations(self, resource):
+                return self.current[resource]
+
+            def is_cloned(self, resource):
+                return resource == 'res_haproxy'
+
+        def advance(seconds):
+            clock[0] += seconds
+
+        ClusterStatus.side_effect = FakeStatus
+        mock_time.side_effect = lambda: clock[0]
+        sleep.side_effect = advance
+
+        results = utils.benchmark_failover(timeout=10, failback_timeout=2,
+                                           interval=1)
+        self.assertEqual(results['failover'],
+                         {'res_vip': 2, 'res_haproxy': 1})
+        # only the clone is waited for, the primitive stays on node2
+        self.assertEqual(results['failback'], {'res_haproxy': 1})
+        self.assertEqual(results['sticky'], ['res_vip'])
+        enter_standby_mode.assert_called_once_with('node1')
+        leave_standby_mode.assert_called_once_with('node1')
+
+    def crm_mon_snapshots(self, snapshots):
+        """Mock ClusterStatus to return one snapshot per refresh
+
+        @param snapshots: list of (standby, dict of resource -> nodes) for
+                          node1, a None node is a stopped instance
+        """
+        def crm_mon(standby, resources):
+            xml = ['<crm_mon><nodes>',
+                   '<node name="node1" online="true" standby="%s"/>' %
+                   str(standby).lower(),
+                   '<node name="node2" online="true" standby="false"/>',
+                   '</nodes><resources>']
+            for resource, nodes in sorted(resources.items()):
+                for node in nodes or [None]:
+                    if node is None:
+                        xml.append('<resource id="%s" role="Stopped" '
+                                   'active="false"/>' % resource)
+                        continue
+                    xml.append('<resource id="%s" role="Started" '
+                               'active="true"><node name="%s"/></resource>' %
+                               (resource, node))
+            xml.append('</resources></crm_mon>')
+            return ''.join(xml)
+
+        xmls = [crm_mon(*snapshot) for snapshot in snapshots]
+
+        class ClusterStatus(utils.pcmk.ClusterStatus):
+            def refresh(self):
+                self._parse(xmls.pop(0))
+
+        return mock.patch.object(utils.pcmk, 'ClusterStatus', ClusterStatus)
+
+    @mock.patch.object(utils, 'assess_status_helper',
+                       lambda: ('active', 'Unit is ready and clustered'))
+    @mock.patch.object(utils, 'set_unit_paused')
+    @mock.patch.object(utils, 'status_set')
+    @mock.patch.object(utils, 'kv')
+    @mock.patch.object(utils.time, 'sleep')
+    @mock.patch.object(utils.time, 'time')
+    @mock.patch.object(utils, 'enter_standby_mode')
+    @mock.patch.object(utils, 'get_hostname', lambda: 'node1')
+    def test_pause_unit(self, enter_standby_mode, mock_time, sleep, kv,
+                        status_set, set_unit_paused):
+        clock = [0]
+        mock_time.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds)
+        store = {}
+        kv.return_value.get.side_effect = store.get
+        kv.return_value.set.side_effect = store.__setitem__
+        progress = mock.Mock()
+
+        running = {'res_vip': ['node1'], 'res_ping': ['node1', 'node2']}
+        migrating = {'res_vip': [], 'res_ping': ['node2']}
+        moved = {'res_vip': ['node2'], 'res_ping': ['node2']}
+        with self.crm_mon_snapshots([(False, running), (True, running),
+                                     (True, migrating), (True, moved)]):
+            utils.pause_unit(timeout=60, interval=5, progress=progress)
+
+        enter_standby_mode.assert_called_once_with('node1')
+        self.assertEqual(store[utils.PAUSED_RESOURCES_KEY],
+                         ['res_ping', 'res_vip'])
+        self.assertEqual(progress.call_args_list,
+                         [mock.call(['res_ping', 'res_vip'], 0),
+                          mock.call([], 5)])
+        self.assertTrue(set_unit_paused.called)
+
+        # resources which do not leave before the deadline fail the pause
+        set_unit_paused.reset_mock()
+        stuck = {'res_vip': ['node1'], 'res_ping': ['node2']}
+        with self.crm_mon_snapshots([(True, stuck)] * 4):
+            with self.assertRaises(Exception) as context:
+                utils.pause_unit(timeout=10, interval=5)
+        self.assertEqual(str(context.exception),
+                         "Couldn't pause: Resources still running on unit "
+                         "after 10s: res_vip")
+        self.assertFalse(set_unit_paused.called)
+        # the resources recorded by the first attempt are kept
+        self.assertEqual(store[utils.PAUSED_RESOURCES_KEY],
+                         ['res_ping', 'res_vip'])
+
+    @mock.patch.object(utils, 'set_unit_status')
+    @mock.patch.object(utils, 'clear_unit_paused')
+    @mock.patch.object(utils, 'kv')
+    @mock.patch.object(utils.time, 'sleep')
+    @mock.patch.object(utils.time, 'time')
+    @mock.patch.object(utils, 'leave_standby_mode')
+    @mock.patch.object(utils, 'get_hostname', lambda: 'node1')
+    def test_resume_unit(self, leave_standby_mode, mock_time, sleep, kv,
+                         clear_unit_paused, set_unit_status):
+        clock = [0]
+        mock_time.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds)
+        kv.return_value.get.return_value = ['res_ping', 'res_vip']
+
+        # res_vip stays on node2, the stopped res_ping instance comes back
+        paused = {'res_vip': ['node2'], 'res_ping': ['node2', None]}
+        resumed = {'res_vip': ['node2'], 'res_ping': ['node1', 'node2']}
+        with self.crm_mon_snapshots([(True, paused), (False, paused),
+                                     (False, resumed)]):
+            utils.resume_unit(timeout=60, interval=5)
+
+        leave_standby_mode.assert_called_once_with('node1')
+        kv.return_value.unset.assert_called_once_with(
+            utils.PAUSED_RESOURCES_KEY)
+        self.assertTrue(clear_unit_paused.called)
+
+        clear_unit_paused.reset_mock()
+        with self.crm_mon_snapshots([(True, paused)] * 2):
+            self.assertRaises(Exception, utils.resume_unit, timeout=5,
+                              interval=5)
+        self.assertFalse(clear_unit_paused.called)
+
+    @mock.patch.object(utils, 'status_set')
+    @mock.patch.object(utils, 'config')
+    def test_get_crypto_settings(self, mock_config, status_set):
+        cfg = {}
+        mock_config.side_effect = cfg.get
+        self.assertEqual(utils.get_crypto_settings(),
+                         {'cipher': 'none', 'hash': 'none', 'threads': 0})
+
+        cfg.update({'corosync_crypto_cipher': 'aes256',
+                    'corosync_crypto_hash': 'sha256',
+                    'corosync_threads': 4})
+        self.assertEqual(utils.get_crypto_settings(),
+                         {'cipher': 'aes256', 'hash': 'sha256', 'threads': 4})
+
+        cfg['corosync_crypto_hash'] = 'none'
+        self.assertRaises(ValueError, utils.get_crypto_settings)
+        cfg['corosync_crypto_hash'] = 'sha256'
+        cfg['corosync_crypto_cipher'] = 'blowfish'
+        self.assertRaises(ValueError, utils.get_crypto_settings)
+        self.assertEqual(status_set.call_args[0][0], 'blocked')
+
+    def test_render_crypto_settings(self):
+        conf = utils.parse_corosync_conf(self.render_corosync_conf())
+        self.assertIn('secauth: off', conf['totem'])
+        self.assertIn('threads: 0', conf['totem'])
+        self.assertFalse([line for line in conf['totem']
+                          if line.startswith('crypto_')])
+
+        conf = utils.parse_corosync_conf(self.render_corosync_conf(
+            crypto={'cipher': 'aes128', 'hash': 'sha1', 'threads': 2}))
+        for line in ['secauth: on', 'crypto_cipher: aes128',
+                     'crypto_hash: sha1', 'threads: 2']:
+            self.assertIn(line, conf['totem'])
+
+    @mock.patch('subprocess.check_output')
+    def test_estimate_crypto_cost(self, check_output):
+        check_output.return_value = (
+            '+DT:aes-256-cbc:3:16\n'
+            '+R:1000:aes-256-cbc:3.00\n'
+            '+H:16:64:256:1024:8192\n'
+            '+F:22:aes-256-cbc:100000000.00:200000000.00:300000000.00:'
+            '400000000.00:500000000.00\n')
+        self.assertEqual(utils.openssl_throughput('aes-256-cbc'),
+                         {16: 1e8, 64: 2e8, 256: 3e8, 1024: 4e8, 8192: 5e8})
+        check_output.assert_called_with(
+            ['openssl', 'speed', '-mr', '-evp', 'aes-256-cbc'],
+            stderr=mock.ANY)
+
+        results = utils.estimate_crypto_cost(1500)
+        self.assertEqual(sorted(results['cipher']),
+                         sorted(utils.COROSYNC_CRYPTO_CIPHERS))
+        # a 1500 byte message is costed at the 1024 byte block rate
+        self.assertEqual(results['hash']['sha256'], (4e8, 3.75))
+
+    @mock.patch.object(utils, 'local_unit', lambda: 'hanode/0')
+    @mock.patch.object(utils, 'get_iface_ipaddr')
+    @mock.patch.object(utils, 'peer_ips')
+    @mock.patch.object(utils, 'config')
+    def test_get_ring1_conf(self, mock_config, peer_ips, get_iface_ipaddr):
+        cfg = {'corosync_ring1_bindiface': 'eth1',
+               'corosync_ring1_mcastaddr': '226.94.1.2',
+               'corosync_rrp_mode': 'passive'}
+        mock_config.side_effect = cfg.get
+        get_iface_ipaddr.return_value = '192.168.0.1'
+        peer_ips.return_value = {'hanode/1': '192.168.0.2',
+                                 'hanode/2': None}
+
+        def bindnetaddr(iface):
+            return '192.168.0.0'
+
+        # not every peer published its address yet
+        self.assertEqual(utils.get_ring1_conf(bindnetaddr), None)
+        peer_ips.assert_called_with(addr_key='ring1-address')
+
+        peer_ips.return_value['hanode/2'] = '192.168.0.3'
+        ring1 = utils.get_ring1_conf(bindnetaddr)
+        self.assertEqual(ring1, {'rrp_mode': 'passive',
+                                 'bindnetaddr': '192.168.0.0',
+                                 'mcastaddr': '226.94.1.2',
+                                 'nodes': {1000: '192.168.0.1',
+                                           1001: '192.168.0.2',
+                                           1002: '192.168.0.3'}})
+
+        conf = utils.parse_corosync_conf(self.render_corosync_conf(
+            ring1=ring1))
+        self.assertIn('rrp_mode: passive', conf['totem'])
+        self.assertIn('ring1_addr: 192.168.0.2', conf['nodelist'])
+
+        conf = utils.parse_corosync_conf(self.render_corosync_conf(
+            ring1=ring1, transport='udp'))
+        self.assertIn('ringnumber: 1', conf['totem'])
+        self.assertIn('mcastaddr: 226.94.1.2', conf['totem'])
+
+        cfg['corosync_rrp_mode'] = 'none'
+        self.assertRaises(ValueError, utils.get_ring1_conf, bindnetaddr)
+
+        cfg['corosync_ring1_bindiface'] = None
+        self.assertEqual(utils.get_ring1_conf(bindnetaddr), None)
+        conf = utils.parse_corosync_conf(self.render_corosync_conf())
+        self.assertIn('rrp_mode: none', conf['totem'])
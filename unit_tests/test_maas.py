@@ -0,0 +1,164 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from six.moves import BaseHTTPServer
+from six.moves.urllib.parse import (
+    parse_qs,
+    urlparse,
+)
+
+import maas
+
+
+def write_file(path, content, *args, **kwargs):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class FakeMAAS(object):
+    """Stand-in MAAS API server listening on localhost"""
+
+    def __init__(self, nodes, power_in_list=True, status=200, raw=None):
+        self.requests = []
+        self.auth = []
+        self.clients = set()
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                fake.requests.append((url.path, params))
+                fake.auth.append(self.headers.get('Authorization'))
+                fake.clients.add(self.client_address)
+                if params['op'] == ['power_parameters']:
+                    body = dict((n['system_id'], n['power_parameters'])
+                                for n in nodes
+                                if n['system_id'] in params['id'])
+                else:
+                    body = [dict(n) for n in nodes
+                            if n['hostname'] in params.get('hostname',
+                                                           [n['hostname']])]
+                    if not power_in_list:
+                        for node in body:
+                            del node['power_parameters']
+
+                body = json.dumps(body) if raw is None else raw
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@mock.patch.object(maas, 'log', lambda *args, **kwargs: None)
+@mock.patch.object(maas, 'write_file', write_file)
+class TestMAASHelper(unittest.TestCase):
+
+    NODES = [{'hostname': 'node%d.maas' % i, 'system_id': 'node-%d' % i,
+              'power_type': 'ipmi',
+              'power_parameters': {'power_address': '10.0.1.%d' % i}}
+             for i in range(1, 11)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(maas, 'MAAS_CACHE_FILE',
+                                    os.path.join(self.tmpdir, 'cache.json'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.helper = maas.MAASHelper('http://maas/MAAS/api/1.0', 'a:b:c')
+
+    def test_list_nodes_filtered(self):
+        server = FakeMAAS(self.NODES, power_in_list=False)
+        self.addCleanup(server.stop)
+        helper = maas.MAASHelper('%s/MAAS/' % server.url, 'ck:tk:ts')
+        nodes = helper.list_nodes(['node1', 'node10'])
+        self.assertEqual(nodes, [
+            {'hostname': 'node1.maas', 'power_type': 'ipmi',
+             'power_parameters': {'power_address': '10.0.1.1'}},
+            {'hostname': 'node10.maas', 'power_type': 'ipmi',
+             'power_parameters': {'power_address': '10.0.1.10'}}])
+
+        # short names do not match the FQDNs, so the second list is
+        # unfiltered, then power parameters are fetched for both nodes
+        self.assertEqual([r[1] for r in server.requests], [
+            {'op': ['list'], 'hostname': ['node1', 'node10']},
+            {'op': ['list']},
+            {'op': ['power_parameters'], 'id': ['node-1', 'node-10']}])
+        self.assertTrue(all(r[0] == '/MAAS/api/1.0/nodes/'
+                            for r in server.requests))
+        # all requests are signed and share one connection
+        auth = server.auth[0]
+        self.assertTrue(auth.startswith('OAuth '))
+        self.assertIn('oauth_consumer_key="ck"', auth)
+        self.assertIn('oauth_token="tk"', auth)
+        self.assertIn('oauth_signature="%26ts"', auth)
+        self.assertEqual(len(server.clients), 1)
+
+    def test_list_nodes_error(self):
+        server = FakeMAAS(self.NODES, status=401)
+        self.addCleanup(server.stop)
+        helper = maas.MAASHelper(server.url + '/MAAS/api/1.0', 'ck:tk:ts')
+        self.assertFalse(helper.list_nodes())
+
+    def test_list_nodes_not_json(self):
+        # a proxy answering with its login page instead of the API
+        server = FakeMAAS(self.NODES, raw='<html>Please log in</html>')
+        self.addCleanup(server.stop)
+        helper = maas.MAASHelper(server.url + '/MAAS/api/1.0', 'ck:tk:ts')
+        self.assertFalse(helper.list_nodes())
+        client = maas.MAASClient(server.url + '/MAAS/api/1.0', 'ck:tk:ts')
+        self.addCleanup(client.close)
+        self.assertRaises(maas.MAASError, client.get, 'nodes/',
+                          [('op', 'list')])
+
+    @mock.patch('time.time')
+    @mock.patch.object(maas.MAASHelper, 'list_nodes')
+    def test_cached_nodes(self, list_nodes, time):
+        list_nodes.side_effect = lambda hosts: [
+            dict((f, n[f]) for f in maas.MAAS_NODE_FIELDS)
+            for n in self.NODES if n['hostname'].split('.')[0] in hosts]
+        time.return_value = 1000
+        nodes = self.helper.cached_nodes(['node1', 'node2'], ttl=60)
+        self.assertEqual(nodes[0], {'hostname': 'node1.maas',
+                                    'power_type': 'ipmi',
+                                    'power_parameters':
+                                    {'power_address': '10.0.1.1'}})
+        self.assertEqual(list_nodes.call_count, 1)
+
+        # served from the cache until it expires
+        time.return_value = 1059
+        self.assertEqual(self.helper.cached_nodes(['node2', 'node1'],
+                                                  ttl=60),
+                         [nodes[1], nodes[0]])
+        self.assertEqual(list_nodes.call_count, 1)
+
+        time.return_value = 1060
+        self.helper.cached_nodes(['node1', 'node2'], ttl=60)
+        self.assertEqual(list_nodes.call_count, 2)
+
+        # a node missing from the cache triggers a refresh
+        self.helper.cached_nodes(['node1', 'node3'], ttl=60)
+        self.assertEqual(list_nodes.call_count, 3)
+        list_nodes.assert_called_with(['node1', 'node3'])
@@ -0,0 +1,47 @@
+import unittest
+
+import netmath
+
+
+class TestNetmath(unittest.TestCase):
+
+    def test_netmask_to_prefixlen(self):
+        self.assertEqual(netmath.netmask_to_prefixlen('255.255.255.0'), 24)
+        self.assertEqual(netmath.netmask_to_prefixlen('255.255.240.0'), 20)
+        self.assertEqual(netmath.netmask_to_prefixlen('0.0.0.0'), 0)
+        self.assertEqual(
+            netmath.netmask_to_prefixlen('ffff:ffff:ffff:ffff::'), 64)
+        self.assertRaises(ValueError, netmath.netmask_to_prefixlen,
+                          '255.0.255.0')
+        self.assertRaises(ValueError, netmath.netmask_to_prefixlen,
+                          '255.255.256.0')
+
+    def test_network_address(self):
+        self.assertEqual(netmath.network_address('10.5.1.20', 16), '10.5.0.0')
+        self.assertEqual(netmath.network_address('10.5.1.20', '255.255.0.0'),
+                         '10.5.0.0')
+        self.assertEqual(netmath.network_address('10.5.1.20', '32'),
+                         '10.5.1.20')
+        self.assertEqual(netmath.network_address('2001:db8:1:2::10', 48),
+                         '2001:db8:1::')
+        self.assertRaises(ValueError, netmath.network_address,
+                          '10.5.1.20', 33)
+
+    def test_in_network(self):
+        self.assertTrue(netmath.in_network('10.5.1.20', '10.5.0.0', 16))
+        self.assertFalse(netmath.in_network('10.6.1.20', '10.5.0.0', 16))
+        self.assertFalse(netmath.in_network('2001:db8::1', '10.5.0.0', 0))
+        self.assertTrue(netmath.in_network('2001:DB8::0001', '2001:db8::',
+                                           'ffff:ffff:ffff:ffff::'))
+
+    def test_addresses_in_networks(self):
+        networks = [('2001:db8:1::10', 64), ('10.5.0.1', '255.255.0.0'),
+                    ('10.6.0.1', 16)]
+        addresses = ['2001:DB8:1::0020', '2001:db8:2::20', '10.5.3.4',
+                     '10.7.0.1', 'bogus'] + \
+            ['10.6.%d.%d' % (i // 256, i % 256) for i in range(2000)]
+        found = netmath.addresses_in_networks(addresses, networks)
+        self.assertEqual(len(found), 2002)
+        self.assertIn('2001:db8:1::20', found)
+        self.assertIn('10.5.3.4', found)
+        self.assertNotIn('10.7.0.1', found)
@@ -0,0 +1,163 @@
+import imp
+import json
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+NRPE_DIR = os.path.join(os.path.dirname(__file__), '..', 'files', 'nrpe')
+
+
+def load_script(name):
+    # the scripts have no .py suffix, do not leave bytecode next to them
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source(name.replace('-', '_'),
+                               os.path.join(NRPE_DIR, name))
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+
+collect_cluster_status = load_script('collect_cluster_status')
+check_crm = load_script('check_crm')
+check_corosync_rings = load_script('check_corosync_rings')
+
+CRM_MON_XML = '''<crm_mon version="1.1.10">
+  <summary>
+    <current_dc present="true" name="juju-1" with_quorum="true"/>
+  </summary>
+  <nodes>
+    <node name="juju-1" online="true" standby="false"/>
+    <node name="juju-2" online="true" standby="true"/>
+    <node name="juju-3" online="false" standby="false"/>
+  </nodes>
+  <resources>
+    <resource id="res_vip" role="Started" active="true" managed="true"
+              failed="false"/>
+    <clone id="cl_haproxy">
+      <resource id="res_haproxy" role="Started" managed="true"
+                failed="false"/>
+      <resource id="res_haproxy" role="Stopped" managed="true"
+                failed="false"/>
+      <resource id="res_haproxy" role="Stopped" managed="true"
+                failed="false"/>
+    </clone>
+  </resources>
+  <node_history>
+    <node name="juju-1">
+      <resource_history id="res_vip" fail-count="2"/>
+      <resource_history id="res_haproxy"/>
+    </node>
+  </node_history>
+</crm_mon>
+'''
+
+CONSTRAINTS_XML = '''<constraints>
+  <rsc_location id="cli-prefer-res_vip" rsc="res_vip" node="juju-1"/>
+  <rsc_location id="loc-res_vip" rsc="res_vip" node="juju-2"/>
+</constraints>
+'''
+
+CFGTOOL = '''Printing ring status.
+Local node ID 1000
+RING ID 0
+\tid\t= 10.0.0.1
+\tstatus\t= ring 0 active with no faults
+RING ID 1
+\tid\t= 192.168.0.1
+\tstatus\t= Marking ringid 1 interface 192.168.0.1 FAULTY
+'''
+
+
+def result(output, rc=0):
+    return {'rc': rc, 'output': output, 'error': ''}
+
+
+class TestNRPEChecks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = os.path.join(self.tmpdir, 'nagios', 'status.json')
+        self.status = {'timestamp': time.time(),
+                       'crm_mon': result(CRM_MON_XML),
+                       'constraints': result(CONSTRAINTS_XML),
+                       'cfgtool': result(CFGTOOL),
+                       'quorum': result('Quorate:          Yes\n')}
+
+    def opts(self, **kwargs):
+        values = {'warning': False, 'standbyignore': False,
+                  'constraint': False, 'failcount': 1}
+        values.update(kwargs)
+        return mock.Mock(**values)
+
+    @mock.patch.object(collect_cluster_status, 'run')
+    def test_collect(self, run):
+        run.side_effect = lambda cmd: result(cmd[0])
+        collect_cluster_status.write_cache(collect_cluster_status.collect(),
+                                           self.cache)
+        with open(self.cache) as f:
+            status = json.load(f)
+
+        self.assertEqual(status['crm_mon']['output'], 'crm_mon')
+        self.assertEqual(status['cfgtool']['output'], 'corosync-cfgtool')
+        self.assertEqual(oct(os.stat(self.cache).st_mode & 0o777), '0644')
+
+    def test_check_crm(self):
+        messages = check_crm.check_crm(self.status, self.opts())
+        self.assertEqual(messages[check_crm.OK], ['Cluster OK'])
+        self.assertEqual(messages[check_crm.CRITICAL],
+                         ['1 Nodes Offline', 'juju-2 in Standby',
+                          'res_haproxy Stopped'])
+        self.assertEqual(messages[check_crm.WARNING],
+                         ['res_vip failure detected, fail-count=2'])
+
+        messages = check_crm.check_crm(
+            self.status, self.opts(warning=True, standbyignore=True,
+                                   constraint=True, failcount=3))
+        self.assertEqual(messages[check_crm.CRITICAL], [])
+        self.assertEqual(messages[check_crm.WARNING],
+                         ['1 Nodes Offline', 'res_haproxy Stopped',
+                          'res_vip blocking location constraint detected'])
+
+        self.status['crm_mon'] = {'rc': 107, 'output': '',
+                                  'error': 'Transport endpoint is not '
+                                  'connected\n'}
+        messages = check_crm.check_crm(self.status, self.opts())
+        self.assertEqual(messages[check_crm.CRITICAL],
+                         ['Connection to cluster FAILED: Transport endpoint '
+                          'is not connected'])
+
+    def test_check_rings(self):
+        check = check_corosync_rings.check_rings
+        self.assertEqual(check(self.status),
+                         (check_corosync_rings.CRITICAL,
+                          ['Marking ringid 1 interface 192.168.0.1 FAULTY']))
+        self.status['cfgtool'] = result(CFGTOOL.split('RING ID 1')[0])
+        self.assertEqual(check(self.status),
+                         (check_corosync_rings.OK, ['ring 0 OK']))
+        self.assertEqual(check(self.status, rings=2),
+                         (check_corosync_rings.CRITICAL,
+                          ['Expected 2 rings but found 1']))
+        self.status['quorum'] = result('Quorate:          No\n', rc=2)
+        self.assertEqual(check(self.status),
+                         (check_corosync_rings.CRITICAL,
+                          ['partition is not quorate']))
+
+    def test_stale_cache(self):
+        self.status['timestamp'] -= 600
+        collect_cluster_status.write_cache(self.status, self.cache)
+        with mock.patch.object(check_crm.sys, 'exit') as exit_:
+            exit_.side_effect = SystemExit
+            self.assertRaises(SystemExit, check_crm.main,
+                              ['--cache', self.cache])
+            exit_.assert_called_once_with(check_crm.UNKNOWN)
+
+            exit_.reset_mock()
+            self.assertRaises(SystemExit, check_crm.main,
+                              ['--cache', self.cache, '--max-age', '900'])
+            exit_.assert_called_once_with(check_crm.CRITICAL)
@@ -0,0 +1,105 @@
+import mock
+import unittest
+
+import ophistory
+import pcmk
+
+CIB_XML = """
+<cib epoch="10" num_updates="2" admin_epoch="0">
+  <configuration/>
+  <status>
+    <node_state id="1000" uname="juju-1">
+      <lrm id="1000">
+        <lrm_resources>
+          <lrm_resource id="res_rbd" type="rbd" class="ocf" provider="ceph">
+            <lrm_rsc_op id="res_rbd_last_0" operation="start" call-id="10"
+                        rc-code="0" interval="0" exec-time="4000"
+                        queue-time="0"/>
+            <lrm_rsc_op id="res_rbd_monitor_10000" operation="monitor"
+                        call-id="11" rc-code="0" interval="10000"
+                        exec-time="6500" queue-time="500"/>
+            <lrm_rsc_op id="res_rbd_last_failure_0" operation="monitor"
+                        call-id="11" rc-code="7" interval="10000"
+                        exec-time="6500" queue-time="500"/>
+          </lrm_resource>
+          <lrm_resource id="res_haproxy:0" type="haproxy" class="lsb">
+            <lrm_rsc_op id="res_haproxy_last_0" operation="start"
+                        call-id="12" rc-code="0" interval="0"
+                        exec-time="100" queue-time="0"/>
+            <lrm_rsc_op id="res_haproxy_monitor_5000" operation="monitor"
+                        call-id="13" rc-code="0" interval="5000"
+                        exec-time="30" queue-time="0"/>
+            <lrm_rsc_op id="res_haproxy_notify_0" operation="notify"
+                        call-id="14" rc-code="0" interval="0"
+                        exec-time="10" queue-time="0"/>
+          </lrm_resource>
+        </lrm_resources>
+      </lrm>
+    </node_state>
+    <node_state id="1001" uname="juju-2">
+      <lrm id="1001">
+        <lrm_resources>
+          <lrm_resource id="res_haproxy:1" type="haproxy" class="lsb">
+            <lrm_rsc_op id="res_haproxy_monitor_0" operation="monitor"
+                        call-id="2" rc-code="7" interval="0"
+                        exec-time="40" queue-time="0"/>
+            <lrm_rsc_op id="res_haproxy_last_0" operation="start"
+                        call-id="5" rc-code="0" interval="0"
+                        exec-time="300" queue-time="20"/>
+          </lrm_resource>
+        </lrm_resources>
+      </lrm>
+    </node_state>
+  </status>
+</cib>
+"""
+
+
+class TestOpHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.ops = ophistory.op_history(pcmk.CIB(CIB_XML))
+
+    def test_op_history(self):
+        # the last failure record repeats the monitor and is not counted
+        self.assertEqual(len(self.ops), 6)
+        self.assertIn({'resource': 'res_rbd', 'agent': 'ocf:ceph:rbd',
+                       'node': 'juju-1', 'operation': 'monitor',
+                       'interval': 10.0, 'exec_time': 6.5,
+                       'queue_time': 0.5, 'rc': 0}, self.ops)
+        self.assertNotIn(7, [op['rc'] for op in self.ops
+                             if op['operation'] == 'monitor'])
+        self.assertIn({'resource': 'res_haproxy', 'agent': 'lsb:haproxy',
+                       'node': 'juju-2', 'operation': 'probe',
+                       'interval': 0.0, 'exec_time': 0.04,
+                       'queue_time': 0.0, 'rc': 7}, self.ops)
+        self.assertEqual(set(op['resource'] for op in self.ops),
+                         set(['res_rbd', 'res_haproxy']))
+
+    @mock.patch.object(pcmk, 'get_cib')
+    def test_op_history_live(self, get_cib):
+        get_cib.return_value = pcmk.CIB(CIB_XML)
+        self.assertEqual(ophistory.op_history(), self.ops)
+
+    def test_percentile(self):
+        values = [4, 1, 3, 2]
+        self.assertEqual(ophistory.percentile(values, 50), 2)
+        self.assertEqual(ophistory.percentile(values, 90), 4)
+        self.assertEqual(ophistory.percentile(values, 0), 1)
+        self.assertEqual(ophistory.percentile([], 50), None)
+
+    def test_latency_summary(self):
+        summary = ophistory.latency_summary(self.ops)
+        self.assertEqual(summary[('res_haproxy', 'start')],
+                         {'count': 2, 'p50': 0.1, 'p90': 0.3, 'p99': 0.3,
+                          'max': 0.3, 'queue_max': 0.02})
+        self.assertEqual(summary[('res_haproxy', 'monitor')]['count'], 1)
+        self.assertEqual(summary[('res_haproxy', 'probe')]['count'], 1)
+        summary = ophistory.latency_summary(self.ops, key='agent')
+        self.assertEqual(summary[('ocf:ceph:rbd', 'start')]['p50'], 4.0)
+
+    def test_slow_monitors(self):
+        slow = ophistory.slow_monitors(self.ops)
+        self.assertEqual([op['resource'] for op in slow], ['res_rbd'])
+        self.assertEqual(ophistory.slow_monitors(self.ops, threshold=0.8),
+                         [])
@@ -7,23 +7,265 @@
 
 import mock
 import pcmk
+import subprocess
 import unittest
 
+CIB_XML = """
+<cib epoch="10" num_updates="2" admin_epoch="0">
+  <configuration>
+    <crm_config>
+      <cluster_property_set id="cib-bootstrap-options">
+        <nvpair id="cib-bootstrap-options-no-quorum-policy"
+                name="no-quorum-policy" value="stop"/>
+        <nvpair id="cib-bootstrap-options-stonith-enabled"
+                name="stonith-enabled" value="false"/>
+      </cluster_property_set>
+    </crm_config>
+    <nodes/>
+    <resources>
+      <primitive id="res_vip" class="ocf" provider="heartbeat"
+                 type="IPaddr2"/>
+      <group id="grp_foo">
+        <primitive id="res_foo" class="ocf" provider="heartbeat"
+                   type="IPaddr2"/>
+      </group>
+      <clone id="cl_ping">
+        <primitive id="ping" class="ocf" provider="pacemaker" type="ping"/>
+      </clone>
+    </resources>
+    <constraints>
+      <rsc_location id="loc_foo" rsc="grp_foo" node="node1" score="100"/>
+    </constraints>
+    <rsc_defaults>
+      <meta_attributes id="rsc-options">
+        <nvpair id="rsc-options-resource-stickiness"
+                name="resource-stickiness" value="100"/>
+      </meta_attributes>
+    </rsc_defaults>
+  </configuration>
+  <status/>
+</cib>
+"""
+
+CRM_MON_XML = """
+<crm_mon version="1.1.14">
+  <nodes>
+    <node name="juju-machine-1" id="1000" online="true" standby="false"/>
+    <node name="juju-machine-2" id="1001" online="true" standby="false"/>
+  </nodes>
+  <resources>
+    <group id="grp_nova" number_resources="2">
+      <resource id="res_nova_consoleauth" role="Started" active="true"
+                failed="false" nodes_running_on="1">
+        <node name="juju-machine-1" id="1000" cached="false"/>
+      </resource>
+      <resource id="res_nova_stopped" role="Stopped" active="false"
+                failed="false" nodes_running_on="0"/>
+    </group>
+    <clone id="cl_ping" multi_state="false" unique="false">
+      <resource id="ping" role="Started" active="true" failed="false">
+        <node name="juju-machine-1" id="1000" cached="false"/>
+      </resource>
+      <resource id="ping" role="Started" active="true" failed="false">
+        <node name="juju-machine-2" id="1001" cached="false"/>
+      </resource>
+    </clone>
+    <clone id="ms_db" multi_state="true" unique="false">
+      <resource id="res_db:0" role="Master" active="true" failed="false">
+        <node name="juju-machine-1" id="1000" cached="false"/>
+      </resource>
+      <resource id="res_db:1" role="Slave" active="true" failed="false">
+        <node name="juju-machine-2" id="1001" cached="false"/>
+      </resource>
+    </clone>
+  </resources>
+  <node_history>
+    <node name="juju-machine-1">
+      <resource_history id="res_nova_consoleauth" fail-count="2"/>
+    </node>
+    <node name="juju-machine-2">
+      <resource_history id="res_nova_consoleauth" fail-count="1"/>
+    </node>
+  </node_history>
+</crm_mon>
+"""
+
 
 class TestPcmk(unittest.TestCase):
-    @mock.patch('commands.getstatusoutput')
-    def test_crm_res_running_true(self, getstatusoutput):
-        getstatusoutput.return_value = (0, ("resource res_nova_consoleauth is "
-                                            "running on: juju-xxx-machine-6"))
+    def setUp(self):
+        pcmk.invalidate_cib()
+        pcmk.invalidate_cluster_status()
+
+    @mock.patch('subprocess.check_output')
+    def test_crm_res_running_true(self, check_output):
+        check_output.return_value = CRM_MON_XML
         self.assertTrue(pcmk.crm_res_running('res_nova_consoleauth'))
+        self.assertTrue(pcmk.crm_res_running('grp_nova'))
+        self.assertTrue(pcmk.crm_res_running('cl_ping'))
+        check_output.assert_called_once_with(['crm_mon', '-X', '-r', '-f'])
 
-    @mock.patch('commands.getstatusoutput')
-    def test_crm_res_running_stopped(self, getstatusoutput):
-        getstatusoutput.return_value = (0, ("resource res_nova_consoleauth is "
-                                            "NOT running"))
-        self.assertFalse(pcmk.crm_res_running('res_nova_consoleauth'))
+    @mock.patch('subprocess.check_output')
+    def test_crm_res_running_stopped(self, check_output):
+        check_output.return_value = CRM_MON_XML
+        self.assertFalse(pcmk.crm_res_running('res_nova_stopped'))
+
+    @mock.patch('subprocess.check_output')
+    def test_crm_res_running_undefined(self, check_output):
+        check_output.return_value = CRM_MON_XML
+        self.assertFalse(pcmk.crm_res_running('res_foobar'))
+        self.assertFalse(pcmk.is_resource_present('res_foobar'))
+        self.assertTrue(pcmk.is_resource_present('res_nova_stopped'))
 
-    @mock.patch('commands.getstatusoutput')
-    def test_crm_res_running_undefined(self, getstatusoutput):
-        getstatusoutput.return_value = (1, "foobar")
+    @mock.patch('subprocess.check_output')
+    def test_crm_res_running_no_cluster(self, check_output):
+        check_output.side_effect = subprocess.CalledProcessError(1, 'crm_mon')
         self.assertFalse(pcmk.crm_res_running('res_nova_consoleauth'))
+
+    def test_cluster_status(self):
+        status = pcmk.ClusterStatus(CRM_MON_XML)
+        self.assertEqual(status.locations('cl_ping'),
+                         ['juju-machine-1', 'juju-machine-2'])
+        self.assertEqual(status.locations('grp_nova'), ['juju-machine-1'])
+        self.assertEqual(status.roles('ms_db'),
+                         {'juju-machine-1': 'Master',
+                          'juju-machine-2': 'Slave'})
+        self.assertEqual(status.failcount('res_nova_consoleauth'), 3)
+        self.assertEqual(status.failcount('res_nova_consoleauth',
+                                          'juju-machine-2'), 1)
+        self.assertEqual(status.failcount('grp_nova'), 3)
+        self.assertEqual(status.resources_on('juju-machine-2'),
+                         ['ping', 'res_db'])
+        self.assertTrue(status.is_online('juju-machine-2'))
+        self.assertFalse(status.is_standby('juju-machine-2'))
+        self.assertFalse(status.is_online('juju-machine-3'))
+        self.assertEqual(status.stopped_instances('res_nova_stopped'), 1)
+        self.assertEqual(status.stopped_instances('cl_ping'), 0)
+        for name in ['ping', 'res_db', 'cl_ping']:
+            self.assertTrue(status.is_cloned(name))
+        for name in ['res_nova_consoleauth', 'grp_nova']:
+            self.assertFalse(status.is_cloned(name))
+
+    @mock.patch('pcmk.commit')
+    def test_config_batch(self, commit):
+        loaded = []
+
+        def fake_commit(cmd, failure_is_fatal=False):
+            self.assertTrue(failure_is_fatal)
+            with open(cmd.split()[-1]) as batch:
+                loaded.append((cmd, batch.read()))
+
+        commit.side_effect = fake_commit
+        batch = pcmk.ConfigBatch()
+        self.assertFalse(batch.commit())
+        batch.add('primitive res_foo ocf:heartbeat:IPaddr2')
+        batch.add('group grp_foo res_foo')
+        self.assertEqual(len(batch), 2)
+        self.assertTrue(batch.commit())
+        self.assertEqual(len(batch), 0)
+
+        self.assertEqual(len(loaded), 1)
+        cmd, content = loaded[0]
+        self.assertTrue(cmd.startswith('crm -w -F configure load update '))
+        self.assertEqual(content, ('primitive res_foo ocf:heartbeat:IPaddr2\n'
+                                   'group grp_foo res_foo\n'))
+
+    @mock.patch('subprocess.check_output')
+    def test_crm_opt_exists(self, check_output):
+        check_output.return_value = CIB_XML
+        pcmk.invalidate_cib()
+        self.assertTrue(pcmk.crm_opt_exists('res_vip'))
+        self.assertTrue(pcmk.crm_opt_exists('grp_foo'))
+        self.assertTrue(pcmk.crm_opt_exists('cl_ping'))
+        self.assertTrue(pcmk.crm_opt_exists('loc_foo'))
+        self.assertFalse(pcmk.crm_opt_exists('res_vip_internal'))
+        self.assertFalse(pcmk.crm_opt_exists('res'))
+        # the snapshot is only taken once
+        check_output.assert_called_once_with(['cibadmin', '-Q'])
+
+    @mock.patch('subprocess.call')
+    @mock.patch('subprocess.check_output')
+    def test_get_cib_invalidated_by_commit(self, check_output, call):
+        check_output.return_value = CIB_XML
+        pcmk.invalidate_cib()
+        cib = pcmk.get_cib()
+        self.assertEqual(cib.properties['no-quorum-policy'], 'stop')
+        self.assertEqual(cib.rsc_defaults['resource-stickiness'], '100')
+        self.assertEqual(sorted(cib.primitives),
+                         ['ping', 'res_foo', 'res_vip'])
+        self.assertIs(pcmk.get_cib(), cib)
+        pcmk.commit('crm configure property stonith-enabled=false')
+        self.assertIsNot(pcmk.get_cib(), cib)
+        self.assertEqual(check_output.call_count, 2)
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch('subprocess.check_output')
+    def test_commit_failure_is_fatal(self, check_output, check_call):
+        check_output.return_value = CIB_XML
+        check_call.side_effect = subprocess.CalledProcessError(1, 'crm')
+        pcmk.invalidate_cib()
+        cib = pcmk.get_cib()
+        self.assertRaises(subprocess.CalledProcessError, pcmk.commit,
+                          'crm configure load update /tmp/batch',
+                          failure_is_fatal=True)
+        check_call.assert_called_once_with(
+            ['crm', 'configure', 'load', 'update', '/tmp/batch'])
+        # a partially applied update still invalidates the snapshot
+        self.assertIsNot(pcmk.get_cib(), cib)
+
+    def test_reconcile(self):
+        cib = pcmk.CIB(CIB_XML)
+        applied = {'res_vip': 'primitive res_vip ocf:heartbeat:IPaddr2',
+                   'grp_foo': 'group grp_foo res_foo',
+                   'loc_foo': 'location loc_foo grp_foo 100: node1'}
+        desired = {'res_vip': ('primitive res_vip ocf:heartbeat:IPaddr2 '
+                               'params ip=10.0.0.10'),
+                   'grp_foo': 'group grp_foo res_foo',
+                   'res_new': 'primitive res_new ocf:heartbeat:IPaddr2'}
+        self.assertEqual(pcmk.reconcile(desired, applied, cib),
+                         (['res_new'], ['res_vip'], ['loc_foo']))
+        # nothing to do once the desired state has been applied
+        self.assertEqual(pcmk.reconcile(applied, applied, cib),
+                         ([], [], []))
+
+    @mock.patch('pcmk.crm_res_running')
+    @mock.patch('pcmk.crm_opt_exists')
+    @mock.patch('pcmk.commit')
+    def test_delete_objects(self, commit, crm_opt_exists, crm_res_running):
+        crm_opt_exists.side_effect = lambda obj: obj != 'res_gone'
+        crm_res_running.side_effect = lambda obj: obj == 'res_foo'
+        self.assertEqual(pcmk.delete_objects(['res_foo', 'res_gone',
+                                              'loc_foo']),
+                         ['res_foo', 'loc_foo'])
+        commit.assert_has_calls([
+            mock.call('crm -w -F resource stop res_foo',
+                      failure_is_fatal=True),
+            mock.call('crm -w -F configure delete res_foo loc_foo',
+                      failure_is_fatal=True)])
+
+    @mock.patch('socket.gethostname', lambda: 'juju-machine-1')
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.check_output')
+    def test_wait_for_pcmk(self, check_output, sleep):
+        check_output.side_effect = [
+            subprocess.CalledProcessError(1, 'crm_node'),
+            '1000 juju-machine-10 member\n',
+            # a node which left is still listed, but as lost
+            '1000 juju-machine-10 member\n1001 juju-machine-1 lost\n',
+            '1000 juju-machine-10 member\n1001 juju-machine-1 member\n']
+        pcmk.wait_for_pcmk()
+        check_output.assert_called_with(['crm_node', '-l'],
+                                        stderr=subprocess.STDOUT)
+        self.assertEqual(check_output.call_count, 4)
+        self.assertEqual(sleep.call_args_list,
+                         [mock.call(1), mock.call(2), mock.call(4)])
+
+    @mock.patch('socket.gethostname', lambda: 'juju-machine-1')
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.check_output')
+    def test_wait_for_pcmk_timeout(self, check_output, sleep, time):
+        check_output.return_value = ''
+        time.side_effect = [0, 0, 4, 11]
+        self.assertRaises(Exception, pcmk.wait_for_pcmk, timeout=10)
+        self.assertEqual(sleep.call_args_list,
+                         [mock.call(1), mock.call(2)])
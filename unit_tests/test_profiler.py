@@ -0,0 +1,42 @@
+import mock
+import subprocess
+import unittest
+
+import profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        patcher = mock.patch.object(profiler, 'kv')
+        kv = patcher.start()
+        self.addCleanup(patcher.stop)
+        kv.return_value.set.side_effect = self.store.__setitem__
+        kv.return_value.getrange.side_effect = (
+            lambda prefix, strip: dict((k[len(prefix):], v) for k, v in
+                                       self.store.items()))
+        self.addCleanup(profiler.disable)
+
+    def test_profile_hook(self):
+        profiler.enable()
+        subprocess.check_call(['true'])
+        subprocess.call(['false'])
+        self.assertRaises(subprocess.CalledProcessError,
+                          subprocess.check_output, ['false'])
+        profiler.disable()
+        subprocess.call(['true'])
+        profiler.enable()
+        profiler.save('config-changed')
+
+        profile = self.store['profile.config-changed']
+        self.assertEqual([(r['cmd'], r['rc']) for r in profile['records']],
+                         [('true', 0), ('false', 1), ('false', 1)])
+
+        summary = profiler.summary(count=2)
+        self.assertEqual(summary['config-changed']['commands'], 3)
+        self.assertEqual(len(summary['config-changed']['slowest']), 2)
+
+    def test_save_disabled(self):
+        profiler.save('config-changed')
+        self.assertEqual(self.store, {})
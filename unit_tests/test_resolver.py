@@ -0,0 +1,64 @@
+import mock
+import socket
+import unittest
+
+import resolver
+
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        patcher = mock.patch.object(resolver, 'kv')
+        kv = patcher.start()
+        self.addCleanup(patcher.stop)
+        kv.return_value.get.side_effect = self.store.get
+        kv.return_value.set.side_effect = self.store.__setitem__
+
+        patcher = mock.patch.object(resolver.dns.resolver, 'query')
+        self.query = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query.side_effect = self.dns_query
+
+    def dns_query(self, hostname, rtype):
+        records = {'node1': '10.0.0.1', 'node2': '10.0.0.2'}
+        if hostname not in records:
+            raise resolver.dns.resolver.NXDOMAIN()
+
+        answers = mock.MagicMock()
+        answers.__getitem__.return_value = records[hostname]
+        answers.rrset.ttl = 60
+        return answers
+
+    @mock.patch.object(resolver.socket, 'gethostbyname')
+    @mock.patch.object(resolver.time, 'time')
+    def test_resolve_hosts(self, time, gethostbyname):
+        time.return_value = 1000
+        gethostbyname.side_effect = socket.gaierror
+        self.assertEqual(
+            resolver.resolve_hosts(['node1', 'node2', 'node1', '10.0.0.3',
+                                    'node4', None]),
+            {'node1': '10.0.0.1', 'node2': '10.0.0.2',
+             '10.0.0.3': '10.0.0.3', 'node4': None})
+        # each name is only looked up once, failures are not cached
+        self.assertEqual(sorted(c[0][0] for c in self.query.call_args_list),
+                         ['node1', 'node2', 'node4'])
+        self.assertEqual(sorted(self.store[resolver.DNS_CACHE_KEY]),
+                         ['node1', 'node2'])
+
+        # cached answers are reused until their TTL runs out
+        self.query.reset_mock()
+        time.return_value = 1059
+        self.assertEqual(resolver.get_host_ip('node1'), '10.0.0.1')
+        self.assertFalse(self.query.called)
+        time.return_value = 1060
+        self.assertEqual(resolver.get_host_ip('node1'), '10.0.0.1')
+        self.query.assert_called_once_with('node1', 'A')
+
+    @mock.patch.object(resolver.socket, 'gethostbyname')
+    def test_get_host_ip_fallback(self, gethostbyname):
+        gethostbyname.return_value = '10.0.0.5'
+        self.assertEqual(resolver.get_host_ip('node5'), '10.0.0.5')
+        gethostbyname.side_effect = socket.gaierror
+        self.assertEqual(resolver.get_host_ip('node6', fallback='node6'),
+                         'node6')